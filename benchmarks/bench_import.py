@@ -0,0 +1,50 @@
+"""
+Import-time benchmark of dataset_loader.
+
+Imports the package in fresh interpreters, reports the median import time
+and fails if a heavy dependency is imported or if the time exceeds
+--max-time seconds.
+"""
+import sys
+import argparse
+import subprocess
+import numpy as np
+
+HEAVY_MODULES = ['pandas', 'joblib', 'nibabel', 'sklearn', 'scipy', 'nilearn']
+
+SNIPPET = """
+import sys, time
+t = time.time()
+import dataset_loader
+dataset_loader.load_adni_masks, dataset_loader.load_atlas
+t = time.time() - t
+heavy = [m for m in %r if m in sys.modules]
+print('%%f %%s' %% (t, ','.join(heavy)))
+""" % (HEAVY_MODULES,)
+
+
+def bench_import(n_runs=10):
+    """Returns the import times and the imported heavy modules
+    """
+    times, heavy = [], set()
+    for _ in range(n_runs):
+        out = subprocess.check_output([sys.executable, '-c', SNIPPET])
+        t, modules = (out.decode().split() + [''])[:2]
+        times.append(float(t))
+        heavy.update(filter(None, modules.split(',')))
+    return np.array(times), sorted(heavy)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--n-runs', type=int, default=10)
+    parser.add_argument('--max-time', type=float, default=.5)
+    args = parser.parse_args()
+
+    times, heavy = bench_import(args.n_runs)
+    print('import dataset_loader: median %.3fs, min %.3fs, max %.3fs' %
+          (np.median(times), times.min(), times.max()))
+    if heavy:
+        print('heavy modules imported: %s' % ', '.join(heavy))
+    if heavy or np.median(times) > args.max_time:
+        sys.exit(1)
@@ -4,6 +4,15 @@ from .dataset import (load_atlas, load_adni_longitudinal_fdg_pet,
                       load_adni_longitudinal_rs_fmri_DARTEL,
                       load_adni_longitudinal_csf_biomarker,
                       load_adni_longitudinal_hippocampus_volume,
-                      load_adni_masks,
+                      load_adni_masks, load_mask,
                       load_adnidod_rs_fmri,
-                      get_demographics,)
+                      load_multimodal_datasets, iter_imgs_data,
+                      compute_group_stats, get_demographics,
+                      get_classification_tasks, CLASSIFICATION_TASKS,
+                      compute_gram_matrix,
+                      cross_val_score_precomputed,
+                      get_trajectories,)
+from .utils import DatasetView
+from .snapshot import (save_dataset_snapshot, load_dataset_snapshot,
+                       record_sources)
+from .resampling import resample_imgs, resample_img
@@ -0,0 +1,48 @@
+"""Cache warm-up entry point, to run once per node before the jobs :
+
+    python -m dataset_loader [-m pet fmri ...] [-j N]
+"""
+import argparse
+import sys
+from dataset_loader.utils import _get_base_dir
+from dataset_loader.dataset import MODALITY_LOADERS, warm_cache
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m dataset_loader',
+        description='Precomputes the dataset loader caches '
+                    '(manifests, phenotype joins, demographics)')
+    parser.add_argument('-m', '--modalities', nargs='+',
+                        choices=sorted(MODALITY_LOADERS.keys()),
+                        default=sorted(MODALITY_LOADERS.keys()),
+                        help='modalities to warm up (default: all)')
+    parser.add_argument('-j', '--n-jobs', type=int, default=1,
+                        help='number of modalities warmed up in parallel')
+    parser.add_argument('-b', '--backend', default='threading',
+                        help='joblib backend (default: threading)')
+    args = parser.parse_args(argv)
+
+    # resolve the data root
+    try:
+        _get_base_dir(verbose=1)
+    except OSError as e:
+        print('error : no data root in paths.pref (%s)' % e,
+              file=sys.stderr)
+        return 1
+
+    reports = warm_cache(args.modalities, n_jobs=args.n_jobs,
+                         backend=args.backend)
+    for report in reports:
+        if report.error is None:
+            print('%-6s built : %6u rows, %5u subjects in %.1fs'
+                  % (report.modality, report.n_rows, report.n_subjects,
+                     report.time))
+        else:
+            print('%-6s failed after %.1fs : %s'
+                  % (report.modality, report.time, report.error))
+    return int(any(report.error is not None for report in reports))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,325 @@
+"""
+Two-tier cache of function results.
+
+The shared cache directory (under the data directory) is the source of
+truth, a node-local directory in front of it serves the reads :
+- a result is read from the local tier, then from the shared tier (and
+  copied to the local tier), and is computed only if both miss,
+- every file is written to a temporary file then renamed, so that
+  concurrent readers and writers never see a partial file,
+- the local tier is bounded in size, least recently used results are
+  evicted first (its size is tracked by each process and recounted
+  every LOCAL_SIZE_RESYNC seconds, when the files written by the
+  other processes are counted),
+- concurrent misses of a result are computed once : the first process
+  takes a lock file next to the shared result, the others wait for it.
+  The holder touches its lock every lock_timeout / 4 seconds, a lock
+  not touched for lock_timeout seconds is considered left by a crashed
+  worker and is broken.
+
+The local tier is set by the DATASET_LOADER_LOCAL_CACHE environment
+variable (an empty value disables it) and its size in megabytes by
+DATASET_LOADER_LOCAL_CACHE_SIZE.
+"""
+import os
+import time
+import socket
+import pickle
+import inspect
+import tempfile
+import threading
+import functools
+from contextlib import contextmanager
+from dataset_loader.utils import _get_cache_base_dir
+
+LOCAL_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'dataset_loader_cache')
+LOCAL_CACHE_SIZE = 1024
+LOCK_TIMEOUT = 600
+LOCAL_SIZE_RESYNC = 60
+
+# tracked local tier sizes : local_dir -> [size in bytes, time of the count]
+_LOCAL_SIZES = {}
+_LOCAL_SIZES_LOCK = threading.Lock()
+
+
+def _atomic_dump(obj, path):
+    """ Pickles obj to path through a temporary file renamed in place
+    """
+    tmp = '%s.%d.%d.tmp' % (path, os.getpid(),
+                            threading.current_thread().ident)
+    try:
+        with open(tmp, 'wb') as f:
+            pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _load(path):
+    """ Returns (True, unpickled content) of path, (False, None) if
+    path is missing or unreadable
+    """
+    try:
+        with open(path, 'rb') as f:
+            return True, pickle.load(f)
+    except Exception:
+        return False, None
+
+
+def _acquire_lock(path):
+    """ Creates the lock file path, returns False if it already exists
+    """
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        if not os.path.exists(path):
+            raise
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write('%s %d' % (socket.gethostname(), os.getpid()))
+    return True
+
+
+def _release_lock(path):
+    """ Removes the lock file path
+    """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+@contextmanager
+def _heartbeat(path, timeout):
+    """ Touches the lock file path every timeout / 4 seconds within the
+    block, so that the lock of a long computation is not broken
+    """
+    stop = threading.Event()
+
+    def touch():
+        while not stop.wait(timeout / 4.):
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+    thread = threading.Thread(target=touch)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _break_stale_lock(path, timeout):
+    """ Removes the lock file path if it was not touched for timeout
+    seconds (its holder stopped its heartbeat)
+    """
+    try:
+        age = time.time() - os.stat(path).st_mtime
+    except OSError:
+        return
+    if age > timeout:
+        # two waiters may break the same lock : the result is then
+        # computed twice, which the atomic writes make harmless
+        _release_lock(path)
+
+
+def _evict_lru(directory, max_size, keep=(), min_age=0):
+    """ Removes the least recently used files of directory
+    until it fits in max_size bytes (temporary and lock files, the files
+    of keep and the files used less than min_age seconds ago are kept),
+    returns the size of the remaining files
+    """
+    keep = set(os.path.abspath(path) for path in keep)
+    now = time.time()
+    entries = []
+    for root, _, files in os.walk(directory):
+        for f in files:
+            if f.endswith('.lock') or '.tmp' in f:
+                continue
+            path = os.path.join(root, f)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    size = sum(e[1] for e in entries)
+    for mtime, file_size, path in sorted(entries):
+        if size <= max_size:
+            break
+        if os.path.abspath(path) in keep or now - mtime < min_age:
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        size -= file_size
+    return size
+
+
+def _func_name(func):
+    """ Returns the cache folder name of a function
+    """
+    name = getattr(func, '__qualname__', func.__name__)
+    return '%s.%s' % (func.__module__, name.replace('<locals>.', ''))
+
+
+def _func_code(func):
+    """ Returns the source of a function (its bytecode if the source is
+    not available), which does not depend on its position in its file
+    """
+    try:
+        return inspect.getsource(func)
+    except (OSError, TypeError):
+        return func.__code__.co_code
+
+
+class TwoTierMemory(object):
+    """ Caches function results in a node-local directory backed by
+    a shared directory
+
+    Parameters
+    ----------
+    shared_dir : shared cache directory (source of truth)
+    local_dir : node-local cache directory, None for
+                DATASET_LOADER_LOCAL_CACHE (default in the temp dir)
+    local_size : size bound of the local directory in megabytes,
+                 None for DATASET_LOADER_LOCAL_CACHE_SIZE (default 1024)
+    lock_timeout : time in seconds after which the lock of a result being
+                   computed, not touched by its holder, is considered
+                   stale
+    """
+    def __init__(self, shared_dir, local_dir=None, local_size=None,
+                 lock_timeout=LOCK_TIMEOUT):
+        if local_dir is None:
+            local_dir = os.environ.get('DATASET_LOADER_LOCAL_CACHE',
+                                       LOCAL_CACHE_DIR)
+        if local_size is None:
+            local_size = float(os.environ.get(
+                'DATASET_LOADER_LOCAL_CACHE_SIZE', LOCAL_CACHE_SIZE))
+        self.shared_dir = shared_dir
+        self.local_dir = local_dir or None
+        self.local_size = int(local_size * 1024 ** 2)
+        self.lock_timeout = lock_timeout
+
+    def _get_key(self, func, args, kwargs):
+        """ Returns the hash of the function name, source and arguments
+        """
+        import joblib
+        return joblib.hash((_func_name(func), _func_code(func), args,
+                            kwargs))
+
+    def _evict(self):
+        """ Removes the least recently used local results
+        until the local tier fits in local_size, and recounts its size
+        """
+        size = _evict_lru(self.local_dir, self.local_size)
+        with _LOCAL_SIZES_LOCK:
+            _LOCAL_SIZES[self.local_dir] = [size, time.time()]
+
+    def _store_local(self, result, local_path):
+        """ Writes a result to the local tier then bounds its size
+        (the local tier is walked only when its tracked size exceeds
+        local_size or is older than LOCAL_SIZE_RESYNC seconds)
+        """
+        try:
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            try:
+                previous_size = os.path.getsize(local_path)
+            except OSError:
+                previous_size = 0
+            _atomic_dump(result, local_path)
+            added = os.path.getsize(local_path) - previous_size
+            with _LOCAL_SIZES_LOCK:
+                tracked = _LOCAL_SIZES.get(self.local_dir)
+                evict = (tracked is None or
+                         time.time() - tracked[1] > LOCAL_SIZE_RESYNC)
+                if not evict:
+                    tracked[0] += added
+                    evict = tracked[0] > self.local_size
+            if evict:
+                self._evict()
+        except OSError:
+            # the local tier is only an accelerator
+            pass
+
+    def _call_shared(self, func, args, kwargs, shared_path):
+        """ Returns the shared result, computed by a single process
+        """
+        lock_path = shared_path + '.lock'
+        delay = .05
+        while True:
+            found, result = _load(shared_path)
+            if found:
+                return result
+            os.makedirs(os.path.dirname(shared_path), exist_ok=True)
+            if _acquire_lock(lock_path):
+                try:
+                    # the result may have been written before the lock
+                    found, result = _load(shared_path)
+                    if not found:
+                        with _heartbeat(lock_path, self.lock_timeout):
+                            result = func(*args, **kwargs)
+                            _atomic_dump(result, shared_path)
+                    return result
+                finally:
+                    _release_lock(lock_path)
+            # another process computes the result
+            _break_stale_lock(lock_path, self.lock_timeout)
+            time.sleep(delay)
+            delay = min(2 * delay, 1.)
+
+    def call(self, func, *args, **kwargs):
+        """ Returns the cached result of func(*args, **kwargs)
+        """
+        return self._call(self._get_key(func, args, kwargs), func, args,
+                          kwargs)
+
+    def call_keyed(self, key, func, *args, **kwargs):
+        """ Returns the cached result of func(*args, **kwargs) stored under
+        key (a fingerprint of arguments too large to be hashed)
+        """
+        return self._call(self._get_key(func, (key,), {}), func, args,
+                          kwargs)
+
+    def _call(self, key, func, args, kwargs):
+        """ Returns the result of func(*args, **kwargs) cached under key
+        """
+        name = '%s.pkl' % key
+        shared_path = os.path.join(self.shared_dir, _func_name(func), name)
+        local_path = None
+        if self.local_dir is not None:
+            local_path = os.path.join(self.local_dir, _func_name(func), name)
+            found, result = _load(local_path)
+            if found:
+                # mtime tracks the last use for the eviction
+                try:
+                    os.utime(local_path, None)
+                except OSError:
+                    pass
+                return result
+
+        result = self._call_shared(func, args, kwargs, shared_path)
+        if local_path is not None:
+            self._store_local(result, local_path)
+        return result
+
+    def cache(self, func):
+        """ Returns func with cached results, as joblib Memory.cache
+        """
+        @functools.wraps(func)
+        def cached_func(*args, **kwargs):
+            return self.call(func, *args, **kwargs)
+        return cached_func
+
+
+def _get_memory():
+    """ Returns the two-tier cache of the loaders
+    """
+    shared_dir = os.path.join(_get_cache_base_dir(), 'dataset_loader',
+                              'load_data_cache')
+    return TwoTierMemory(shared_dir)
@@ -1,16 +1,36 @@
 import os
+import time
 import numpy as np
-import pandas as pd
-from datetime import date, datetime
-from joblib import Memory
-from sklearn.datasets.base import Bunch
-from dataset_loader.utils import (_get_data_base_dir, _rid_to_ptid, _get_dx,
+from dataset_loader.utils import (Bunch, DatasetView, _LazyModule,
+                                  _get_data_base_dir, _rid_to_ptid, _get_dx,
                                   _get_cache_base_dir, _glob_subject_img,
                                   _ptid_to_rid, _get_group_indices,
-                                  _get_subjects_and_description, _get_vcodes,
-                                  _get_dob, _get_gender, _get_mmse, _get_cdr,
+                                  _get_subjects_and_description,
+                                  _get_dobs, _get_gender, _get_mmse, _get_cdr,
                                   _get_gdscale, _get_faq, _get_npiq,
-                                  _get_adas, _get_nss, _get_neurobat)
+                                  _get_adas, _get_nss, _get_neurobat,
+                                  _read_csv, _to_datetime64, _get_ages,
+                                  _to_categorical, _get_codes,
+                                  _get_label_indices,
+                                  _take_aligned, _join_indices,
+                                  _asof_join_indices, _ptids_to_rids,
+                                  _attach_phenotype, _get_median_scores,
+                                  _load_imgs_block, _iter_dequantized,
+                                  _accumulate_moments, _merge_label_moments,
+                                  _get_group_moments, _merge_io_stats,
+                                  _io_report, _combine_masks,
+                                  _get_change_times, _change_features,
+                                  _block_change_features,
+                                  _filter_description, _get_task,
+                                  _get_task_splits, _gram_matrix,
+                                  _array_fingerprint, _get_mask,
+                                  _train_and_score_precomputed,
+                                  _build_trajectories, _add_source,
+                                  _record_sources)
+from dataset_loader.cache import _get_memory
+from dataset_loader.snapshot import _fingerprint
+
+pd = _LazyModule('pandas')
 
 
 DX_LIST = np.array(['None',
@@ -24,14 +44,45 @@ DX_LIST = np.array(['None',
                     'AD->MCI',
                     'AD->Normal'])
 
+# codebook of the integer-coded dx_group columns
+DX_CODEBOOK = np.hstack((DX_LIST, ['EMCI', 'LMCI', 'SMC', 'MCI-Converter']))
+
+# groupings of the classification tasks
+CLASSIFICATION_TASKS = {'AD-Normal': ['AD', 'Normal'],
+                        'AD-MCI': ['AD', 'MCI'],
+                        'MCI-Normal': ['MCI', 'Normal'],
+                        'AD-rest': ['AD', 'AD-rest'],
+                        'MCI-rest': ['MCI', 'MCI-rest'],
+                        'Normal-rest': ['Normal', 'Normal-rest'],
+                        'AD-MCI-Normal': ['AD', 'MCI', 'Normal']}
+
+# columns of the clinical tables shared by the loaders
+ROSTER_COLUMNS = ['RID', 'PTID']
+DXSUM_COLUMNS = ['RID', 'VISCODE', 'VISCODE2', 'EXAMDATE',
+                 'DXCHANGE', 'DXCURREN']
+
+
+def _encode_dataset(dataset):
+    """Stores dx_group, subjects and visit codes of a dataset
+    as integer-coded categoricals
+    """
+    for k in ['dx_group', 'dx_exam', 'subjects', 'exam_codes',
+              'exam_codes2']:
+        if k in dataset.keys() and dataset[k] is not None:
+            codebook = DX_CODEBOOK if k.startswith('dx_') else None
+            dataset[k] = _to_categorical(dataset[k], codebook)
+    return dataset
+
 
 def load_adni_longitudinal_mmse_score():
     """ Returns longitudinal mmse scores
     """
     BASE_DIR = _get_data_base_dir('ADNI_csv')
-    roster = pd.read_csv(os.path.join(BASE_DIR, 'ROSTER.csv'))
-    dx = pd.read_csv(os.path.join(BASE_DIR, 'DXSUM_PDXCONV_ADNIALL.csv'))
-    fs = pd.read_csv(os.path.join(BASE_DIR, 'MMSE.csv'))
+    roster = _read_csv(os.path.join(BASE_DIR, 'ROSTER.csv'), ROSTER_COLUMNS)
+    dx = _read_csv(os.path.join(BASE_DIR, 'DXSUM_PDXCONV_ADNIALL.csv'),
+                   DXSUM_COLUMNS)
+    fs = _read_csv(os.path.join(BASE_DIR, 'MMSE.csv'),
+                   ['RID', 'VISCODE', 'VISCODE2', 'MMSCORE'])
 
     # extract nans free mmse
     mmse = fs['MMSCORE'].values
@@ -42,11 +93,7 @@ def load_adni_longitudinal_mmse_score():
     rids = fs['RID'].values[idx_num]
 
     # caching dataframe extraction functions
-    CACHE_DIR = _get_cache_base_dir()
-    cache_dir = os.path.join(CACHE_DIR, 'joblib', 'load_data_cache')
-    if not os.path.isdir(cache_dir):
-        os.makedirs(cache_dir)
-    memory = Memory(cachedir=cache_dir, verbose=0)
+    memory = _get_memory()
 
     def _getptidsmmse(rids):
         return [_rid_to_ptid(rid, roster) for rid in rids]
@@ -66,26 +113,59 @@ def load_adni_longitudinal_mmse_score():
     # get diagnosis
     dx_group = memory.cache(_getdxmmse)(rids, vcodes2)
 
-    return Bunch(dx_group=np.array(dx_group), subjects=np.array(ptids),
-                 mmse=mmse, exam_codes=vcodes, exam_codes2=vcodes2)
+    dataset = Bunch(dx_group=np.array(dx_group), subjects=np.array(ptids),
+                    mmse=mmse, exam_codes=vcodes, exam_codes2=vcodes2)
+    return _encode_dataset(dataset)
+
+
+def get_trajectories(dataset, score, subject_key='subjects',
+                     visit_key='exam_codes2', sparse=False):
+    """ Returns the subject x visit-month matrix of a score
+    (mmse, csf, hipp, ... or any column of a clinical table).
+
+    Visit months are read from the visit codes (VISCODE2), only the
+    months observed at least once are columns, visits with unknown codes
+    are dropped and repeated visits are averaged.
+
+    Parameters
+    ----------
+    dataset : loader dataset, or clinical table (DataFrame, e.g. ADAS,
+              CDR, FAQ with subject_key='RID', visit_key='VISCODE2')
+    score : key of the score, one or several values per visit
+    sparse : returns data and mask as scipy.sparse CSR matrices
+             (one value per visit only), stored entries are the visits
+
+    Returns a Bunch of subjects, months, data (subjects x months
+    (x values), nan where missing) and mask (True where observed)
+    """
+    subjects, months, data, mask = _build_trajectories(
+        dataset[subject_key], dataset[visit_key], dataset[score])
+    if sparse:
+        if data.ndim != 2:
+            raise ValueError('sparse trajectories need one value per visit')
+        from scipy.sparse import csr_matrix
+        rows, cols = np.nonzero(mask)
+        data = csr_matrix((data[rows, cols], (rows, cols)), shape=mask.shape)
+        mask = csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)),
+                          shape=mask.shape)
+    return Bunch(subjects=subjects, months=months, data=data, mask=mask)
 
 
 def load_adni_longitudinal_csf_biomarker():
     """ Returns longitudinal csf measures
     """
     BASE_DIR = _get_data_base_dir('ADNI_csv')
-    roster = pd.read_csv(os.path.join(BASE_DIR, 'ROSTER.csv'))
-    dx = pd.read_csv(os.path.join(BASE_DIR, 'DXSUM_PDXCONV_ADNIALL.csv'))
+    roster = _read_csv(os.path.join(BASE_DIR, 'ROSTER.csv'), ROSTER_COLUMNS)
+    dx = _read_csv(os.path.join(BASE_DIR, 'DXSUM_PDXCONV_ADNIALL.csv'),
+                   DXSUM_COLUMNS)
     csf_files = ['UPENNBIOMK.csv', 'UPENNBIOMK2.csv', 'UPENNBIOMK3.csv',
                  'UPENNBIOMK4_09_06_12.csv', 'UPENNBIOMK5_10_31_13.csv',
                  'UPENNBIOMK6_07_02_13.csv', 'UPENNBIOMK7.csv',
                  'UPENNBIOMK8.csv']
     cols = ['RID', 'VISCODE', 'ABETA', 'PTAU', 'TAU']
     # 3,4,5,7,8
-    csf = pd.DataFrame()
-    for csf_file in csf_files[2:]:
-        fs = pd.read_csv(os.path.join(BASE_DIR, csf_file))
-        csf = csf.append(fs[cols])
+    csf = pd.concat([_read_csv(os.path.join(BASE_DIR, csf_file), cols)
+                     for csf_file in csf_files[2:]])
 
     # remove nans from csf values
     biom = csf[cols[2:]].values
@@ -96,11 +176,7 @@ def load_adni_longitudinal_csf_biomarker():
     rids = csf['RID'].values[idx]
 
     # caching dataframe extraction functions
-    CACHE_DIR = _get_cache_base_dir()
-    cache_dir = os.path.join(CACHE_DIR, 'joblib', 'load_data_cache')
-    if not os.path.isdir(cache_dir):
-        os.makedirs(cache_dir)
-    memory = Memory(cachedir=cache_dir, verbose=0)
+    memory = _get_memory()
 
     def _getptidscsf(rids):
         return list(map(lambda x: _rid_to_ptid(x, roster), rids))
@@ -112,9 +188,10 @@ def load_adni_longitudinal_csf_biomarker():
                    rids, vcodes))
     dx_group = memory.cache(_getdxcsf)(rids, vcodes)
 
-    return Bunch(dx_group=np.array(dx_group), subjects=np.array(ptids),
-                 csf=np.array(biom), exam_codes=np.array(vcodes),
-                 exam_codes2=np.array(vcodes))
+    dataset = Bunch(dx_group=np.array(dx_group), subjects=np.array(ptids),
+                    csf=np.array(biom), exam_codes=np.array(vcodes),
+                    exam_codes2=np.array(vcodes))
+    return _encode_dataset(dataset)
 
 
 def load_adni_longitudinal_hippocampus_volume():
@@ -123,13 +200,16 @@ def load_adni_longitudinal_hippocampus_volume():
 
     BASE_DIR = _get_data_base_dir('ADNI_csv')
 
-    roster = pd.read_csv(os.path.join(BASE_DIR, 'ROSTER.csv'))
-    dx = pd.read_csv(os.path.join(BASE_DIR, 'DXSUM_PDXCONV_ADNIALL.csv'))
-    fs = pd.read_csv(os.path.join(BASE_DIR, 'UCSFFSX51_05_20_15.csv'))
-
-    # extract hippocampus numerical values
+    # hippocampus numerical values
     column_idx = np.arange(131, 147)
     cols = ['ST' + str(c) + 'HS' for c in column_idx]
+
+    roster = _read_csv(os.path.join(BASE_DIR, 'ROSTER.csv'), ROSTER_COLUMNS)
+    dx = _read_csv(os.path.join(BASE_DIR, 'DXSUM_PDXCONV_ADNIALL.csv'),
+                   DXSUM_COLUMNS)
+    fs = _read_csv(os.path.join(BASE_DIR, 'UCSFFSX51_05_20_15.csv'),
+                   ['RID', 'VISCODE', 'VISCODE2', 'EXAMDATE'] + cols)
+
     hipp = fs[cols].values
     idx_num = np.array([~np.isnan(h).all() for h in hipp])
     hipp = hipp[idx_num, :]
@@ -138,11 +218,7 @@ def load_adni_longitudinal_hippocampus_volume():
     rids = fs['RID'].values[idx_num]
 
     # caching dataframe extraction functions
-    CACHE_DIR = _get_cache_base_dir()
-    cache_dir = os.path.join(CACHE_DIR, 'joblib', 'load_data_cache')
-    if not os.path.isdir(cache_dir):
-        os.makedirs(cache_dir)
-    memory = Memory(cachedir=cache_dir, verbose=0)
+    memory = _get_memory()
 
     # get subject id
     def _getptidshippo(rids):
@@ -150,40 +226,126 @@ def load_adni_longitudinal_hippocampus_volume():
     ptids = memory.cache(_getptidshippo)(rids)
 
     # extract exam date
-    exams = fs['EXAMDATE'].values[idx_num]
+    exams = _to_datetime64(fs['EXAMDATE'].values[idx_num])
     vcodes = fs['VISCODE'].values[idx_num]
     vcodes2 = fs['VISCODE2'].values[idx_num]
-    exams = list(map(
-        lambda e: date(int(e[:4]), int(e[5:7]), int(e[8:])), exams))
-    exams = np.array(exams)
-
-    # extract diagnosis
-    def _getdxhippo(rids, exams):
-        return np.array(list(map(_get_dx, rids, [dx]*len(rids), exams)))
-    dx_ind = memory.cache(_getdxhippo)(rids, exams)
+
+    # extract diagnosis of the closest clinical visit
+    dx_ind = _attach_phenotype(rids, exams, dx)[3]
     dx_group = DX_LIST[dx_ind]
 
-    return Bunch(dx_group=np.array(dx_group), subjects=np.array(ptids),
-                 hipp=np.array(hipp), exam_dates=np.array(exams),
-                 exam_codes=np.array(vcodes), exam_codes2=np.array(vcodes2))
+    dataset = Bunch(dx_group=np.array(dx_group), subjects=np.array(ptids),
+                    hipp=np.array(hipp), exam_dates=exams,
+                    exam_codes=np.array(vcodes), exam_codes2=np.array(vcodes2))
+    return _encode_dataset(dataset)
+
+
+def _select_images(description, roster, dx, date_column,
+                   date_format='%Y-%m-%d', max_gap=None, subjects=None,
+                   dx_groups=None, exam_codes=None, date_range=None):
+    """Returns the description rows of the images passing the filters
+    and their phenotype (exam dates, visit codes, visit codes 2, dx codes)
+    """
+    description = description[_filter_description(
+        description, subjects=subjects, dx_groups=dx_groups,
+        date_range=date_range, date_column=date_column,
+        date_format=date_format)]
+
+    # attach the closest clinical visit to each image
+    exams = _to_datetime64(description[date_column].values, date_format)
+    rids = _ptids_to_rids(description['Subject_ID'].values, roster)
+    phenotype = _attach_phenotype(rids, exams, dx, max_gap=max_gap)
+
+    if exam_codes is not None:
+        keep = np.isin(np.asarray(phenotype[2]).astype(str), exam_codes)
+        description = description[keep]
+        phenotype = tuple(p[keep] for p in phenotype)
+    return description, phenotype
+
+
+def _cached_manifest(loader, dirname, **kwargs):
+    """ Returns loader(dirname=dirname, **kwargs), cached on disk and keyed
+    on the fingerprints of the image directory, of its description and
+    exclusion files and of the clinical tables the loader reads
+    (images added to an existing subject directory are not seen until
+    the image directory changes)
+    """
+    base_dir = _get_data_base_dir(dirname)
+    csv_dir = _get_data_base_dir('ADNI_csv')
+    sources = [base_dir,
+               os.path.join(base_dir, 'excluded_subjects.txt'),
+               os.path.join(base_dir, 'description_file.csv'),
+               os.path.join(csv_dir, 'DXSUM_PDXCONV_ADNIALL.csv'),
+               os.path.join(csv_dir, 'ROSTER.csv')]
+    try:
+        key = (dirname, kwargs, _fingerprint(sources))
+    except OSError:
+        # the loader reports the missing file
+        return loader(dirname=dirname, **kwargs)
+    dataset = _get_memory().call_keyed(key, loader, dirname=dirname,
+                                       **kwargs)
+    # a cached manifest reads none of its sources
+    for source in sources:
+        _add_source(source)
+    return dataset
 
 
-def load_adni_longitudinal_rs_fmri_DARTEL():
+def load_adni_longitudinal_rs_fmri_DARTEL(max_gap=None, subjects=None,
+                                          dx_groups=None, exam_codes=None,
+                                          date_range=None):
     """ Returns longitudinal func processed with DARTEL
     """
     return load_adni_longitudinal_rs_fmri('ADNI_longitudinal_rs_fmri_DARTEL',
-                                          'resampled*.nii')
+                                          'resampled*.nii', max_gap=max_gap,
+                                          subjects=subjects,
+                                          dx_groups=dx_groups,
+                                          exam_codes=exam_codes,
+                                          date_range=date_range)
 
 
 def load_adni_longitudinal_rs_fmri(dirname='ADNI_longitudinal_rs_fmri',
-                                   prefix='wr*.nii'):
+                                   prefix='wr*.nii', max_gap=None,
+                                   subjects=None, dx_groups=None,
+                                   exam_codes=None, date_range=None):
     """ Returns paths of ADNI rs-fMRI
+        max_gap : maximum number of days between an image
+                  and its clinical visit (None for no limit)
+        subjects, dx_groups, exam_codes, date_range : keep only the images
+                  of these subjects, dx groups, visit codes (VISCODE2) and
+                  exam dates (start, end), filtered before globbing
+    """
+    return _cached_manifest(_load_adni_longitudinal_rs_fmri, dirname,
+                            prefix=prefix, max_gap=max_gap,
+                            subjects=subjects, dx_groups=dx_groups,
+                            exam_codes=exam_codes, date_range=date_range)
+
+
+def _load_adni_longitudinal_rs_fmri(dirname, prefix, max_gap=None,
+                                    subjects=None, dx_groups=None,
+                                    exam_codes=None, date_range=None):
+    """ Returns paths of ADNI rs-fMRI, see load_adni_longitudinal_rs_fmri
     """
 
     # get file paths and description
     images, subject_paths, description = _get_subjects_and_description(
         base_dir=dirname, prefix='I[0-9]*')
     images = np.array(images)
+
+    # get phenotype from csv
+    dx = _read_csv(os.path.join(_get_data_base_dir('ADNI_csv'),
+                                'DXSUM_PDXCONV_ADNIALL.csv'), DXSUM_COLUMNS)
+    roster = _read_csv(os.path.join(_get_data_base_dir('ADNI_csv'),
+                                    'ROSTER.csv'), ROSTER_COLUMNS)
+    description, phenotype = _select_images(
+        description, roster, dx, 'EXAM_DATE', max_gap=max_gap,
+        subjects=subjects, dx_groups=dx_groups, exam_codes=exam_codes,
+        date_range=date_range)
+    if any(f is not None for f in [subjects, dx_groups, exam_codes,
+                                   date_range]):
+        # only the remaining images are globbed
+        keep = np.isin(images, description['Image_ID'].values)
+        images, subject_paths = images[keep], subject_paths[keep]
+
     # get func files
     func_files = list(map(lambda x: _glob_subject_img(
         x, suffix='func/' + prefix, first_img=True),
@@ -195,45 +357,20 @@ def load_adni_longitudinal_rs_fmri(dirname='ADNI_longitudinal_rs_fmri',
     motions = list(map(lambda x: _glob_subject_img(
         x, suffix='func/' + 'rp_*.txt', first_img=True), subject_paths))
 
-    # get phenotype from csv
-    dx = pd.read_csv(os.path.join(_get_data_base_dir('ADNI_csv'),
-                                  'DXSUM_PDXCONV_ADNIALL.csv'))
-    roster = pd.read_csv(os.path.join(_get_data_base_dir('ADNI_csv'),
-                                      'ROSTER.csv'))
-    df = description[description['Image_ID'].isin(images)]
-    df = df.sort_values(by='Image_ID')
+    in_df = description['Image_ID'].isin(images).values
+    df = description[in_df]
+    order = np.argsort(df['Image_ID'].values, kind='mergesort')
+    df = df.iloc[order]
+    exam_dates, vcodes, vcodes2, dx_codes = [p[in_df][order]
+                                             for p in phenotype]
     dx_group = np.array(df['DX_Group'])
     subjects = np.array(df['Subject_ID'])
-    exams = np.array(df['EXAM_DATE'])
-    exams = [date(int(e[:4]), int(e[5:7]), int(e[8:])) for e in exams]
-
-    # caching dataframe extraction functions
-    CACHE_DIR = _get_cache_base_dir()
-    cache_dir = os.path.join(CACHE_DIR, 'joblib', 'load_data_cache')
-    if not os.path.isdir(cache_dir):
-        os.makedirs(cache_dir)
-    memory = Memory(cachedir=cache_dir, verbose=0)
-
-    def _get_ridsfmri(subjects):
-        return [_ptid_to_rid(s, roster) for s in subjects]
-    rids = np.array(memory.cache(_get_ridsfmri)(subjects))
 
-    def _get_examdatesfmri(rids):
-        return [_get_dx(rids[i], dx, exams[i], viscode=None, return_code=True)
-                for i in range(len(rids))]
-
-    exam_dates = np.array(memory.cache(_get_examdatesfmri)(rids))
-
-    def _get_viscodesfmri(rids):
-        return [_get_vcodes(rids[i], str(exam_dates[i]), dx)
-                for i in range(len(rids))]
-    viscodes = np.array(memory.cache(_get_viscodesfmri)(rids))
-    vcodes, vcodes2 = viscodes[:, 0], viscodes[:, 1]
-
-    return Bunch(func=func_files, dx_group=dx_group, exam_codes=vcodes,
-                 exam_dates=exam_dates, exam_codes2=vcodes2,
-                 motion=motions,
-                 subjects=subjects, images=images)
+    dataset = Bunch(func=func_files, dx_group=dx_group, exam_codes=vcodes,
+                    exam_dates=exam_dates, exam_codes2=vcodes2,
+                    dx_exam=DX_LIST[dx_codes], motion=motions,
+                    subjects=subjects, images=images)
+    return _encode_dataset(dataset)
     # return Bunch(func=func_files, dx_group=dx_group,
     #              subjects=subjects, images=images)
 
@@ -257,24 +394,60 @@ def load_adni_rs_fmri():
     dx_group = np.array(df['DX_Group_x'])
     mmscores = np.array(df['MMSCORE'])
 
-    return Bunch(func=func_files, dx_group=dx_group,
-                 mmscores=mmscores, subjects=subjects)
+    dataset = Bunch(func=func_files, dx_group=dx_group,
+                    mmscores=mmscores, subjects=subjects)
+    return _encode_dataset(dataset)
 
 
-def load_adni_longitudinal_av45_pet():
+def load_adni_longitudinal_av45_pet(max_gap=None, subjects=None,
+                                    dx_groups=None, exam_codes=None,
+                                    date_range=None):
     """Returns paths of longitudinal ADNI AV45-PET
+        max_gap : maximum number of days between an image
+                  and its clinical visit (None for no limit)
+        subjects, dx_groups, exam_codes, date_range : keep only the images
+                  of these subjects, dx groups, visit codes (VISCODE2) and
+                  exam dates (start, end), filtered before globbing
+    """
+    return _cached_manifest(_load_adni_longitudinal_av45_pet,
+                            'ADNI_av45_pet', max_gap=max_gap,
+                            subjects=subjects, dx_groups=dx_groups,
+                            exam_codes=exam_codes, date_range=date_range)
+
+
+def _load_adni_longitudinal_av45_pet(dirname, max_gap=None, subjects=None,
+                                     dx_groups=None, exam_codes=None,
+                                     date_range=None):
+    """Returns paths of longitudinal ADNI AV45-PET,
+    see load_adni_longitudinal_av45_pet
     """
 
     # get file paths and description
-    (subjects,
+    (image_dirs,
      subject_paths,
-     description) = _get_subjects_and_description(base_dir='ADNI_av45_pet',
+     description) = _get_subjects_and_description(base_dir=dirname,
                                                   prefix='I[0-9]*')
 
+    # get phenotype from csv
+    dx = _read_csv(os.path.join(_get_data_base_dir('ADNI_csv'),
+                                'DXSUM_PDXCONV_ADNIALL.csv'), DXSUM_COLUMNS)
+    roster = _read_csv(os.path.join(_get_data_base_dir('ADNI_csv'),
+                                    'ROSTER.csv'), ROSTER_COLUMNS)
+    description, phenotype = _select_images(
+        description, roster, dx, 'Study_Date', '%m/%d/%Y', max_gap=max_gap,
+        subjects=subjects, dx_groups=dx_groups, exam_codes=exam_codes,
+        date_range=date_range)
+    filtered = any(f is not None for f in [subjects, dx_groups, exam_codes,
+                                           date_range])
+    if filtered:
+        # only the remaining images are globbed
+        subject_paths = subject_paths[np.isin(
+            image_dirs, description['Image_ID'].values)]
+
     # get pet files
-    pet_files = map(lambda x: _glob_subject_img(x, suffix='pet/wr*.nii',
-                                                first_img=False),
-                    subject_paths).tolist()
+    pet_files = list(map(lambda x: _glob_subject_img(x, suffix='pet/wr*.nii',
+                                                     first_img=False),
+                         subject_paths))
     idx = [0]
     pet_files_all = []
     for pet_file in pet_files:
@@ -285,59 +458,67 @@ def load_adni_longitudinal_av45_pet():
     images = [os.path.split(pet_file)[-1].split('_')[-1][:-4]
               for pet_file in pet_files_all]
     images = np.array(images)
+    if filtered:
+        keep = np.isin(images, description['Image_ID'].values)
+        pet_files_all, images = pet_files_all[keep], images[keep]
 
-    # get phenotype from csv
-    dx = pd.read_csv(os.path.join(_get_data_base_dir('ADNI_csv'),
-                                  'DXSUM_PDXCONV_ADNIALL.csv'))
-    roster = pd.read_csv(os.path.join(_get_data_base_dir('ADNI_csv'),
-                                      'ROSTER.csv'))
-    df = description[description['Image_ID'].isin(images)]
+    in_df = description['Image_ID'].isin(images).values
+    df = description[in_df]
+    exam_dates, vcodes, vcodes2, dx_codes = [p[in_df] for p in phenotype]
     dx_group_all = np.array(df['DX_Group'])
     subjects_all = np.array(df['Subject_ID'])
     ages = np.array(df['Age'])
 
-    exams = np.array(df['Study_Date'])
-    exams = list(map(lambda e: datetime.strptime(e, '%m/%d/%Y').date(), exams))
+    dataset = Bunch(pet=pet_files_all,
+                    dx_group=dx_group_all, dx_exam=DX_LIST[dx_codes],
+                    images=images, ages=ages, subjects=subjects_all,
+                    exam_codes=vcodes, exam_dates=exam_dates,
+                    exam_codes2=vcodes2)
+    return _encode_dataset(dataset)
 
-    # caching dataframe extraction functions
-    CACHE_DIR = _get_cache_base_dir()
-    cache_dir = os.path.join(CACHE_DIR, 'joblib', 'load_data_cache')
-    if not os.path.isdir(cache_dir):
-        os.makedirs(cache_dir)
-    memory = Memory(cachedir=cache_dir, verbose=0)
-
-    def _get_ridspet(subjects_all):
-        return list(map(lambda s: _ptid_to_rid(s, roster), subjects_all))
-    rids = memory.cache(_get_ridspet)(subjects_all)
-
-    def _get_examdatespet(rids):
-        return list(map(lambda i: _get_dx(
-            rids[i], dx, exams[i], viscode=None, return_code=True),
-                        range(len(rids))))
-    exam_dates = np.array(memory.cache(_get_examdatespet)(rids))
-
-    def _get_viscodespet(rids):
-        return list(map(lambda i: _get_vcodes(
-            rids[i], str(exam_dates[i]), dx), range(len(rids))))
-    viscodes = np.array(memory.cache(_get_viscodespet)(rids))
-    if len(viscodes) > 0:
-        vcodes, vcodes2 = viscodes[:, 0], viscodes[:, 1]
-    else:
-        vcodes, vcodes2 = None, None
 
-    return Bunch(pet=pet_files_all,
-                 dx_group=dx_group_all,
-                 images=images, ages=ages, subjects=subjects_all,
-                 exam_codes=vcodes, exam_dates=exam_dates, exam_codes2=vcodes2)
+def load_adni_longitudinal_fdg_pet(max_gap=None, subjects=None,
+                                   dx_groups=None, exam_codes=None,
+                                   date_range=None):
+    """Returns paths of longitudinal ADNI FDG-PET
+        max_gap : maximum number of days between an image
+                  and its clinical visit (None for no limit)
+        subjects, dx_groups, exam_codes, date_range : keep only the images
+                  of these subjects, dx groups, visit codes (VISCODE2) and
+                  exam dates (start, end), filtered before globbing
+    """
+    return _cached_manifest(_load_adni_longitudinal_fdg_pet,
+                            'ADNI_longitudinal_fdg_pet', max_gap=max_gap,
+                            subjects=subjects, dx_groups=dx_groups,
+                            exam_codes=exam_codes, date_range=date_range)
 
 
-def load_adni_longitudinal_fdg_pet():
-    """Returns paths of longitudinal ADNI FDG-PET
+def _load_adni_longitudinal_fdg_pet(dirname, max_gap=None, subjects=None,
+                                    dx_groups=None, exam_codes=None,
+                                    date_range=None):
+    """Returns paths of longitudinal ADNI FDG-PET,
+    see load_adni_longitudinal_fdg_pet
     """
 
     # get file paths and description
-    (subjects, subject_paths, description) = _get_subjects_and_description(
-        base_dir='ADNI_longitudinal_fdg_pet', prefix='[0-9]*')
+    (subject_dirs, subject_paths, description) = \
+        _get_subjects_and_description(base_dir=dirname, prefix='[0-9]*')
+
+    # get phenotype from csv
+    dx = _read_csv(os.path.join(_get_data_base_dir('ADNI_csv'),
+                                'DXSUM_PDXCONV_ADNIALL.csv'), DXSUM_COLUMNS)
+    roster = _read_csv(os.path.join(_get_data_base_dir('ADNI_csv'),
+                                    'ROSTER.csv'), ROSTER_COLUMNS)
+    description, phenotype = _select_images(
+        description, roster, dx, 'Exam_Date', max_gap=max_gap,
+        subjects=subjects, dx_groups=dx_groups, exam_codes=exam_codes,
+        date_range=date_range)
+    filtered = any(f is not None for f in [subjects, dx_groups, exam_codes,
+                                           date_range])
+    if filtered:
+        # only the subjects with remaining images are globbed
+        subject_paths = subject_paths[np.isin(
+            subject_dirs, description['Subject_ID'].values)]
 
     # get pet files
     pet_files = list(map(lambda x: _glob_subject_img(
@@ -352,49 +533,34 @@ def load_adni_longitudinal_fdg_pet():
     images = [os.path.split(pet_file)[-1].split('_')[-1][:-4]
               for pet_file in pet_files_all]
     images = np.array(images)
+    if filtered:
+        keep = np.isin(images, description['Image_ID'].values)
+        pet_files_all, images = pet_files_all[keep], images[keep]
 
-    # get phenotype from csv
-    dx = pd.read_csv(os.path.join(_get_data_base_dir('ADNI_csv'),
-                                  'DXSUM_PDXCONV_ADNIALL.csv'))
-    roster = pd.read_csv(os.path.join(_get_data_base_dir('ADNI_csv'),
-                                      'ROSTER.csv'))
-    df = description[description['Image_ID'].isin(images)]
+    in_df = description['Image_ID'].isin(images).values
+    df = description[in_df]
+    exam_dates, vcodes, vcodes2, dx_codes = [p[in_df] for p in phenotype]
     dx_group_all = np.array(df['DX_Group'])
     dx_conv_all = np.array(df['DX_Conv'])
     subjects_all = np.array(df['Subject_ID'])
     ages = np.array(df['Age'])
 
-    exams = np.array(df['Exam_Date'])
-    exams = list(map(lambda e: date(int(e[:4]), int(e[5:7]), int(e[8:])),
-                     exams))
+    dataset = Bunch(pet=pet_files_all,
+                    dx_group=dx_group_all, dx_conv=dx_conv_all,
+                    dx_exam=DX_LIST[dx_codes],
+                    images=images, ages=ages, subjects=subjects_all,
+                    exam_codes=vcodes, exam_dates=exam_dates,
+                    exam_codes2=vcodes2)
+    return _encode_dataset(dataset)
 
-    # caching dataframe extraction functions
-    CACHE_DIR = _get_cache_base_dir()
-    cache_dir = os.path.join(CACHE_DIR, 'joblib', 'load_data_cache')
-    if not os.path.isdir(cache_dir):
-        os.makedirs(cache_dir)
-    memory = Memory(cachedir=cache_dir, verbose=0)
 
-    def _get_ridspet(subjects_all):
-        return list(map(lambda s: _ptid_to_rid(s, roster), subjects_all))
-    rids = memory.cache(_get_ridspet)(subjects_all)
-
-    def _get_examdatespet(rids):
-        return list(map(lambda i: _get_dx(
-            rids[i], dx, exams[i], viscode=None, return_code=True),
-                        range(len(rids))))
-    exam_dates = np.array(memory.cache(_get_examdatespet)(rids))
-
-    def _get_viscodespet(rids):
-        return list(map(lambda i: _get_vcodes(
-            rids[i], str(exam_dates[i]), dx), range(len(rids))))
-    viscodes = np.array(memory.cache(_get_viscodespet)(rids))
-    vcodes, vcodes2 = viscodes[:, 0], viscodes[:, 1]
-
-    return Bunch(pet=pet_files_all,
-                 dx_group=dx_group_all, dx_conv=dx_conv_all,
-                 images=images, ages=ages, subjects=subjects_all,
-                 exam_codes=vcodes, exam_dates=exam_dates, exam_codes2=vcodes2)
+# longitudinal loader of each modality
+MODALITY_LOADERS = {'pet': load_adni_longitudinal_fdg_pet,
+                    'av45': load_adni_longitudinal_av45_pet,
+                    'fmri': load_adni_longitudinal_rs_fmri_DARTEL,
+                    'csf': load_adni_longitudinal_csf_biomarker,
+                    'hippo': load_adni_longitudinal_hippocampus_volume,
+                    'mmse': load_adni_longitudinal_mmse_score}
 
 
 def load_adni_baseline_rs_fmri():
@@ -414,7 +580,8 @@ def load_adni_baseline_rs_fmri():
     df = description[description['Subject_ID'].isin(subjects)]
     dx_group = np.array(df['DX_Group'])
 
-    return Bunch(func=func_files, dx_group=dx_group, subjects=subjects)
+    dataset = Bunch(func=func_files, dx_group=dx_group, subjects=subjects)
+    return _encode_dataset(dataset)
 
 
 def load_adni_rs_fmri_conn(filename):
@@ -429,10 +596,11 @@ def load_adni_rs_fmri_conn(filename):
     dataset = load_adni_petmr()
     subj_list = dataset['subjects']
 
-    return Bunch(fmri_data=conn_file,
-                 dx_group=np.array(dataset['dx_group']),
-                 mmscores=np.array(dataset['mmscores']),
-                 subjects=subj_list)
+    dataset = Bunch(fmri_data=conn_file,
+                    dx_group=np.array(dataset['dx_group']),
+                    mmscores=np.array(dataset['mmscores']),
+                    subjects=subj_list)
+    return _encode_dataset(dataset)
 
 
 def load_adni_fdg_pet():
@@ -454,8 +622,9 @@ def load_adni_fdg_pet():
     dx_group = np.array(df['DX_Group'])
     mmscores = np.array(df['MMSCORE'])
 
-    return Bunch(pet=pet_files, dx_group=dx_group,
-                 mmscores=mmscores, subjects=subjects)
+    dataset = Bunch(pet=pet_files, dx_group=dx_group,
+                    mmscores=mmscores, subjects=subjects)
+    return _encode_dataset(dataset)
 
 
 def load_adni_fdg_pet_diff():
@@ -463,21 +632,18 @@ def load_adni_fdg_pet_diff():
     """
     pet_dataset = load_adni_fdg_pet()
     fmri_dataset = load_adni_rs_fmri()
-    remaining_subjects = np.setdiff1d(pet_dataset['subjects'],
-                                      fmri_dataset['subjects'])
-    pet_idx = []
-    for pet_subject in remaining_subjects:
-        pet_idx.append(
-            np.where(np.array(pet_dataset['subjects']) == pet_subject)[0][0])
-    pet_idx = np.array(pet_idx, dtype=np.intp)
+    pet_idx, _ = _join_indices([pet_dataset['subjects']],
+                               [fmri_dataset['subjects']], how='anti')
+    remaining_subjects = np.asarray(pet_dataset['subjects'])[pet_idx]
     pet_groups = np.array(pet_dataset['dx_group'])
     pet_groups = pet_groups[pet_idx]
     pet_mmscores = np.array(pet_dataset['mmscores'])
     pet_mmscores = pet_mmscores[pet_idx]
     pet_files = np.array(pet_dataset['pet'])[pet_idx]
 
-    return Bunch(pet=pet_files, dx_group=pet_groups,
-                 mmscores=pet_mmscores, subjects=remaining_subjects)
+    dataset = Bunch(pet=pet_files, dx_group=pet_groups,
+                    mmscores=pet_mmscores, subjects=remaining_subjects)
+    return _encode_dataset(dataset)
 
 
 def load_adni_petmr():
@@ -485,21 +651,9 @@ def load_adni_petmr():
     """
     pet_dataset = load_adni_fdg_pet()
     fmri_dataset = load_adni_rs_fmri()
-    petmr_subjects = np.intersect1d(pet_dataset['subjects'],
-                                    fmri_dataset['subjects'],
-                                    assume_unique=True)
-    petmr_idx = []
-    mrpet_idx = []
-    for petmr_subject in petmr_subjects:
-        petmr_idx.append(
-            np.where(
-                np.array(pet_dataset['subjects']) == petmr_subject)[0][0])
-        mrpet_idx.append(
-            np.where(
-                np.array(fmri_dataset['subjects']) == petmr_subject)[0][0])
-
-    petmr_idx = np.array(petmr_idx, dtype=np.intp)
-    mrpet_idx = np.array(mrpet_idx, dtype=np.intp)
+    petmr_idx, mrpet_idx = _join_indices([pet_dataset['subjects']],
+                                         [fmri_dataset['subjects']])
+    petmr_subjects = np.asarray(pet_dataset['subjects'])[petmr_idx]
     pet_groups = np.array(pet_dataset['dx_group'])
     petmr_groups = pet_groups[petmr_idx]
     pet_mmscores = np.array(pet_dataset['mmscores'])
@@ -507,8 +661,9 @@ def load_adni_petmr():
     func_files = np.array(fmri_dataset['func'])[mrpet_idx]
     pet_files = np.array(pet_dataset['pet'])[petmr_idx]
 
-    return Bunch(func=func_files, pet=pet_files, dx_group=petmr_groups,
-                 mmscores=petmr_mmscores, subjects=petmr_subjects)
+    dataset = Bunch(func=func_files, pet=pet_files, dx_group=petmr_groups,
+                    mmscores=petmr_mmscores, subjects=petmr_subjects)
+    return _encode_dataset(dataset)
 
 
 def load_adni_masks():
@@ -538,6 +693,31 @@ def load_adni_masks():
                                                 '.nii.gz'))
 
 
+def load_mask(masks, how='intersection'):
+    """Returns a mask loaded once and cached, as a Bunch of its boolean
+    mask, flat int32 voxel indices, shape, affine and bounding box
+
+    Parameters
+    ----------
+    masks : mask file or name of load_adni_masks (pet, fmri, petmr, ...),
+            or list of them
+    how : 'intersection' or 'union' of a list of masks (cached as well)
+    """
+    if isinstance(masks, str):
+        masks = [masks]
+    adni_masks = None
+    mask_files = []
+    for mask in masks:
+        if isinstance(mask, str) and not os.path.isfile(mask):
+            if adni_masks is None:
+                adni_masks = load_adni_masks()
+            if mask not in adni_masks:
+                raise ValueError('%s not found !' % mask)
+            mask = adni_masks[mask]
+        mask_files.append(mask)
+    return _combine_masks(mask_files, how)
+
+
 def load_atlas(atlas_name):
     """Retruns selected atlas path
         atlas_names values are : msdl, harvard_oxford, juelich, mayo ...
@@ -576,86 +756,146 @@ def load_atlas(atlas_name):
     return atlas
 
 
-def intersect_datasets(dataset1, dataset2, intersect_on='exam_codes'):
-    """Returns the intersection of two dataset Bunches.
-        The output is a dataset (Bunch).
-        The intersection is on patient id and visit code or date
+def join_datasets(dataset1, dataset2, join_on='exam_codes', how='inner',
+                  tolerance=0):
+    """Returns aligned row indices (idx1, idx2) of the join of two dataset
+    Bunches, on patient id and visit code (join_on='exam_codes')
+    or exam date (join_on='exam_dates').
+    Unmatched rows are indexed -1.
+
+    Parameters
+    ----------
+    how : 'inner', 'left', 'outer' or 'anti' (rows of dataset1
+          without a match in dataset2)
+    tolerance : maximum number of days between matched exam dates,
+                each dataset1 row is matched to the nearest exam date
     """
-    if intersect_on not in ['exam_codes', 'exam_dates']:
-        raise ValueError('intersect_on should be either '
+    if join_on not in ['exam_codes', 'exam_dates']:
+        raise ValueError('join_on should be either '
                          'exam_codes or exam_dates')
-        return -1
 
     if 'subjects' not in dataset1.keys() or 'subjects' not in dataset2.keys():
-        raise ValueError('Cannot intersect, Subject ID not found !')
-        return -1
-
-    if (intersect_on not in dataset1.keys() or
-       intersect_on not in dataset2.keys()):
-        raise ValueError('Cannot intersect,' + intersect_on + ' not found !')
-        return -1
-    return 0
+        raise ValueError('Cannot join, Subject ID not found !')
+
+    if (join_on not in dataset1.keys() or
+       join_on not in dataset2.keys()):
+        raise ValueError('Cannot join,' + join_on + ' not found !')
+
+    if join_on == 'exam_codes':
+        return _join_indices([dataset1.subjects, dataset1.exam_codes],
+                             [dataset2.subjects, dataset2.exam_codes],
+                             how=how)
+
+    if how not in ['inner', 'left', 'outer', 'anti']:
+        raise ValueError('how should be inner, left, outer or anti '
+                         'you gave %s' % how)
+    idx2 = _asof_join_indices(dataset1.subjects, dataset1.exam_dates,
+                              dataset2.subjects, dataset2.exam_dates,
+                              tolerance=tolerance)
+    idx1 = np.arange(len(idx2))
+    if how in ['inner', 'anti']:
+        keep = idx2 >= 0 if how == 'inner' else idx2 < 0
+        idx1, idx2 = idx1[keep], idx2[keep]
+    elif how == 'outer':
+        unmatched = np.setdiff1d(np.arange(len(dataset2.subjects)), idx2)
+        idx1 = np.hstack((idx1, -np.ones(len(unmatched), dtype=np.intp)))
+        idx2 = np.hstack((idx2, unmatched))
+    return idx1, idx2
+
+
+def intersect_datasets(dataset1, dataset2, intersect_on='exam_codes',
+                       how='inner', tolerance=0):
+    """Returns the intersection of two dataset Bunches.
+        The output is a dataset (Bunch).
+        The intersection is on patient id and visit code or date
+        (see join_datasets for how and tolerance).
+        Fields of both datasets are aligned on the joined rows,
+        dataset1 values are kept for the fields they share.
+    """
+    idx1, idx2 = join_datasets(dataset1, dataset2, join_on=intersect_on,
+                               how=how, tolerance=tolerance)
+    n1, n2 = len(dataset1.subjects), len(dataset2.subjects)
+    only2 = idx1 < 0
+
+    dataset = Bunch()
+    for k in dataset1.keys():
+        if not hasattr(dataset1[k], '__len__') or len(dataset1[k]) != n1:
+            dataset[k] = dataset1[k]
+            continue
+        values = _take_aligned(dataset1[k], idx1)
+        if only2.any() and k in dataset2.keys():
+            # outer join : rows only in dataset2 take dataset2 values
+            values2 = _take_aligned(dataset2[k], idx2)
+            if np.asarray(values).dtype != np.asarray(values2).dtype:
+                values = np.asarray(values, dtype=object)
+                values2 = np.asarray(values2, dtype=object)
+            values = np.where(only2.reshape((-1,) + (1,) *
+                                            (np.ndim(values) - 1)),
+                              values2, values)
+        dataset[k] = values
+    if how != 'anti':
+        for k in dataset2.keys():
+            if k in dataset.keys():
+                continue
+            if not hasattr(dataset2[k], '__len__') or len(dataset2[k]) != n2:
+                dataset[k] = dataset2[k]
+            else:
+                dataset[k] = _take_aligned(dataset2[k], idx2)
+    return _encode_dataset(dataset)
 
 
 def extract_baseline_dataset(dataset):
-    """Returns baseline bunch of a dataset
+    """Returns a view of the baseline rows of a dataset
+    (fields are gathered on access, materialize() returns a Bunch)
     """
     # equivalent keys are : 'sc', 'bl', 'scmri'
-    idx = np.hstack((np.where(dataset.exam_codes2 == 'sc'),
-                     np.where(dataset.exam_codes2 == 'bl'),
-                     np.where(dataset.exam_codes2 == 'scmri'))).ravel()
-
-    for k in dataset.keys():
-        dataset[k] = np.array(dataset[k])
-        dataset[k] = dataset[k][idx]
-
-    return dataset
+    idx = np.hstack(_get_label_indices(dataset.exam_codes2,
+                                       ['sc', 'bl', 'scmri']))
+    return DatasetView(dataset, idx)
 
 
 def extract_unique_dataset(dataset):
-    """Returns unique bunch of a dataset
+    """Returns a view of the first row of each subject of a dataset
+    (fields are gathered on access, materialize() returns a Bunch)
     """
-    _, unique_idx = np.unique(dataset.subjects, return_index=True)
-    for k in dataset.keys():
-        dataset[k] = np.array(dataset[k])
-        dataset[k] = dataset[k][unique_idx]
-    return dataset
+    _, unique_idx = np.unique(_get_codes(dataset.subjects)[0],
+                              return_index=True)
+    return DatasetView(dataset, unique_idx)
 
 
 def get_demographics(subjects, exam_dates=None):
     """Returns demographic informations (dob, gender)
     """
     BASE_DIR = _get_data_base_dir('ADNI_csv')
-    demog = pd.read_csv(os.path.join(BASE_DIR, 'PTDEMOG.csv'))
-    roster = pd.read_csv(os.path.join(BASE_DIR, 'ROSTER.csv'))
-    mmse = pd.read_csv(os.path.join(BASE_DIR, 'MMSE.csv'))
-    cdr = pd.read_csv(os.path.join(BASE_DIR, 'CDR.csv'))
-    gdscale = pd.read_csv(os.path.join(BASE_DIR, 'GDSCALE.csv'))
-    faq = pd.read_csv(os.path.join(BASE_DIR, 'FAQ.csv'))
-    npiq = pd.read_csv(os.path.join(BASE_DIR, 'NPIQ.csv'))
-    adas1 = pd.read_csv(os.path.join(BASE_DIR, 'ADASSCORES.csv'))
-    adas2 = pd.read_csv(os.path.join(BASE_DIR, 'ADAS_ADNIGO2.csv'))
-    nss = pd.read_csv(os.path.join(BASE_DIR, 'UWNPSYCHSUM_01_12_16.csv'))
-    neurobat = pd.read_csv(os.path.join(BASE_DIR, 'NEUROBAT.csv'))
+    demog = _read_csv(os.path.join(BASE_DIR, 'PTDEMOG.csv'),
+                      ['RID', 'PTDOBYY', 'PTDOBMM', 'PTGENDER'])
+    roster = _read_csv(os.path.join(BASE_DIR, 'ROSTER.csv'), ROSTER_COLUMNS)
+    mmse = _read_csv(os.path.join(BASE_DIR, 'MMSE.csv'), ['RID', 'MMSCORE'])
+    cdr = _read_csv(os.path.join(BASE_DIR, 'CDR.csv'), ['RID', 'CDGLOBAL'])
+    gdscale = _read_csv(os.path.join(BASE_DIR, 'GDSCALE.csv'),
+                        ['RID', 'GDTOTAL'])
+    faq = _read_csv(os.path.join(BASE_DIR, 'FAQ.csv'), ['RID', 'FAQTOTAL'])
+    npiq = _read_csv(os.path.join(BASE_DIR, 'NPIQ.csv'), ['RID', 'NPISCORE'])
+    adas1 = _read_csv(os.path.join(BASE_DIR, 'ADASSCORES.csv'),
+                      ['RID', 'TOTAL11', 'TOTALMOD'])
+    adas2 = _read_csv(os.path.join(BASE_DIR, 'ADAS_ADNIGO2.csv'),
+                      ['RID', 'TOTSCORE', 'TOTAL13'])
+    nss = _read_csv(os.path.join(BASE_DIR, 'UWNPSYCHSUM_01_12_16.csv'),
+                    ['RID', 'ADNI_MEM', 'ADNI_EF'])
+    neurobat = _read_csv(os.path.join(BASE_DIR, 'NEUROBAT.csv'),
+                         ['RID', 'LDELTOTAL', 'LIMMTOTAL'])
 
     # caching dataframe extraction functions
-    CACHE_DIR = _get_cache_base_dir()
-    cache_dir = os.path.join(CACHE_DIR, 'joblib', 'load_data_cache')
-    if not os.path.isdir(cache_dir):
-        os.makedirs(cache_dir)
-    memory = Memory(cachedir=cache_dir, verbose=0)
+    memory = _get_memory()
 
     def _get_ridsdemo(subjects):
         return [_ptid_to_rid(s, roster) for s in subjects]
     rids = np.array(memory.cache(_get_ridsdemo)(subjects))
 
-    def _get_dobdemo(rids):
-        return [_get_dob(r, demog) for r in rids]
-    dobs = np.array(memory.cache(_get_dobdemo)(rids))
+    dobs = _get_dobs(rids, demog)
     if exam_dates is not None:
         # compute age
-        age = [np.round(abs(e - d).days/365., decimals=2)
-               for e, d in zip(exam_dates, dobs)]
+        age = _get_ages(exam_dates, dobs)
 
     def _get_genderdemo(rids):
         return [_get_gender(r, demog) for r in rids]
@@ -709,9 +949,121 @@ def get_demographics(subjects, exam_dates=None):
                      ldel=nb1, limm=nb2)
 
 
-def load_longitudinal_dataset(modality='pet', nb_imgs_min=3, nb_imgs_max=5):
+def load_multimodal_datasets(modalities=('pet', 'av45', 'fmri', 'csf',
+                                         'hippo'),
+                             n_jobs=1, backend='threading'):
+    """Loads several longitudinal datasets concurrently.
+    With the threading backend, the clinical tables shared by the loaders
+    are parsed once and reused by all of them.
+
+    Parameters
+    ----------
+    modalities : list of keys of MODALITY_LOADERS
+    n_jobs : number of loaders run in parallel
+    backend : joblib backend ('threading', or 'loky' / 'multiprocessing'
+              where each process parses its own tables)
+
+    Returns
+    -------
+    datasets : dict modality -> Bunch
+    """
+    for modality in modalities:
+        if modality not in MODALITY_LOADERS:
+            raise ValueError('%s not found !' % modality)
+    from joblib import Parallel, delayed
+    results = Parallel(n_jobs=n_jobs, backend=backend)(
+        delayed(_load_recording_sources)(MODALITY_LOADERS[modality])
+        for modality in modalities)
+    # the sources read by the workers are recorded in this thread
+    for _, sources in results:
+        for source in sources:
+            _add_source(source)
+    return dict(zip(modalities, [dataset for dataset, _ in results]))
+
+
+def _load_recording_sources(loader):
+    """Returns the dataset of a loader and the files and directories
+    it read
+    """
+    with _record_sources() as sources:
+        return loader(), sources
+
+
+def _warm_modality(modality):
+    """Runs the loader of a modality and the demographics of its subjects,
+    returns a report Bunch
+    """
+    t0 = time.time()
+    try:
+        dataset = MODALITY_LOADERS[modality]()
+        get_demographics(dataset.subjects, dataset.get('exam_dates'))
+    except Exception as e:
+        return Bunch(modality=modality, n_rows=0, n_subjects=0,
+                     time=time.time() - t0,
+                     error='%s: %s' % (type(e).__name__, e))
+    return Bunch(modality=modality, n_rows=len(dataset.subjects),
+                 n_subjects=len(np.unique(_get_codes(dataset.subjects)[0])),
+                 time=time.time() - t0, error=None)
+
+
+def warm_cache(modalities=None, n_jobs=1, backend='threading'):
+    """Precomputes the caches of the loaders (file manifests, phenotype
+    joins, demographic tables) of the given modalities in parallel.
+    Returns a list of report Bunches (modality, n_rows, n_subjects,
+    time, error)
+    """
+    if modalities is None:
+        modalities = sorted(MODALITY_LOADERS.keys())
+    for modality in modalities:
+        if modality not in MODALITY_LOADERS:
+            raise ValueError('%s not found !' % modality)
+    from joblib import Parallel, delayed
+    return Parallel(n_jobs=n_jobs, backend=backend)(
+        delayed(_warm_modality)(modality) for modality in modalities)
+
+
+def load_longitudinal_dataset(modality='pet', nb_imgs_min=3, nb_imgs_max=5,
+                              load_imgs=False, mask=None, n_jobs=1,
+                              memmap_file=None, quantize=None,
+                              change_features=False, verbose=0):
     """ Extract longitudinal images
+
+    Parameters
+    ----------
+    load_imgs : also load the pet / av45 images (masked by the mask file
+                if given) on n_jobs processes into one float32 memmap
+                (memmap_file, or a temporary file) :
+                imgs_data : baseline images of the subjects then their
+                            follow-up images,
+                imgs_data_baseline : view of the baseline images,
+                imgs_offsets : follow-up images of subject i are
+                               imgs_data[imgs_offsets[i]:imgs_offsets[i + 1]]
+    quantize : storage of imgs_data, None (float32), 'float16' or 'uint16'
+               (with the per-image imgs_data_scale and imgs_data_min,
+               NaN voxels are coded 65535 in uint16).
+               imgs_data_error and imgs_data_rmse are the per-image max
+               and rms reconstruction errors, iter_imgs_data dequantizes
+               imgs_data by chunks
+    imgs_data_key is a hash of the block sources (images versions, mask
+    and quantize mode), used as cache key by compute_gram_matrix.
+    imgs_io holds the images read, the bytes read (only the bounding box
+    of the mask is read from uncompressed .nii files), the bytes of the
+    full images and the reading time, printed if verbose
+    change_features : also compute, for csf, hippo and the pet / av45
+                      images (loaded as with load_imgs) :
+                change_time : years between each follow-up and its
+                              baseline (exam dates, else VISCODE2
+                              months),
+                change_delta : follow-up minus baseline features,
+                change_slope : per-subject least squares slopes per year,
+                change_offsets : follow-ups of subject i are
+                                 rows change_offsets[i]:change_offsets[i+1]
+                                 of change_time and change_delta
     """
+    if (load_imgs or change_features) and modality == 'fmri':
+        raise ValueError('Images can only be loaded for pet and av45')
+    if change_features and modality in ['pet', 'av45']:
+        load_imgs = True
 
     if modality == 'pet':
         dataset = load_adni_longitudinal_fdg_pet()
@@ -724,12 +1076,14 @@ def load_longitudinal_dataset(modality='pet', nb_imgs_min=3, nb_imgs_max=5):
         img_key = 'func'
     elif modality == 'csf':
         dataset = load_adni_longitudinal_csf_biomarker()
+        values = np.asarray(dataset.csf, dtype=np.float64)
         # transform data as list of arrays
         dataset['csf'] = np.array(list(
             map(lambda C: '_'.join([str(c) for c in C]), dataset.csf)))
         img_key = 'csf'
     elif modality == 'hippo':
         dataset = load_adni_longitudinal_hippocampus_volume()
+        values = np.asarray(dataset.hipp, dtype=np.float64)
         # transform data as list of arrays
         dataset['hipp'] = np.array(list(
             map(lambda H: '_'.join([str(h) for h in H]), dataset.hipp)))
@@ -737,6 +1091,12 @@ def load_longitudinal_dataset(modality='pet', nb_imgs_min=3, nb_imgs_max=5):
     else:
         raise ValueError('%s not found !' % modality)
 
+    # per-subject arrays are built from decoded columns
+    for k in ['dx_group', 'dx_exam', 'subjects', 'exam_codes',
+              'exam_codes2']:
+        if k in dataset.keys() and dataset[k] is not None:
+            dataset[k] = np.asarray(dataset[k])
+
     df = pd.DataFrame(data=dataset)
     grouped = df.groupby('subjects').groups
 
@@ -782,16 +1142,217 @@ def load_longitudinal_dataset(modality='pet', nb_imgs_min=3, nb_imgs_max=5):
         ages_baseline = np.hstack([dataset.ages[grouped[s][0]]
                                    for s in subjects])
         ages = np.array([dataset.ages[grouped[s]] for s in subjects])
-        return Bunch(imgs=imgs, imgs_baseline=imgs_baseline,
-                     dx_group=dx_all, dx_group_baseline=dx_group,
-                     subjects=subj, subjects_baseline=subjects,
-                     ages=ages, ages_baseline=ages_baseline,
-                     exams=exams_all, exams_baseline=exams,)
+
+    if change_features:
+        # baseline row and follow-up rows of each subject
+        subject_rows = [np.asarray(grouped[s]) for s in subjects]
+        baseline_rows = np.array([r[0] for r in subject_rows], dtype=int)
+        followup_rows = np.hstack([r[1:] for r in subject_rows] +
+                                  [np.zeros(0, dtype=int)]).astype(int)
+        change_offsets = np.hstack(([0], np.cumsum(
+            [len(r) - 1 for r in subject_rows]))).astype(np.int64)
+        # the exam dates are exact, the ages of the descriptions are rounded
+        change_time = _get_change_times(
+            baseline_rows, followup_rows, change_offsets,
+            dataset.exam_codes2, dataset.get('exam_dates'))
+
+    dataset = Bunch(imgs=imgs, imgs_baseline=imgs_baseline,
+                    dx_group=dx_all, dx_group_baseline=dx_group,
+                    subjects=subj, subjects_baseline=subjects,
+                    exams=exams_all, exams_baseline=exams,)
+    if modality in ['pet', 'av45']:
+        dataset['ages'] = ages
+        dataset['ages_baseline'] = ages_baseline
+
+    if load_imgs:
+        # baseline rows first, then the follow-up rows of each subject
+        followups = [img[1:] for img in imgs]
+        n_followups = np.array([len(f) for f in followups], dtype=np.int64)
+        offsets = len(subjects) + np.hstack(([0], np.cumsum(n_followups)))
+        img_files = np.hstack([imgs_baseline] + followups)
+        imgs_data, stats, io_stats = _load_imgs_block(img_files, mask,
+                                                      n_jobs, memmap_file,
+                                                      quantize)
+        if verbose:
+            print(_io_report(io_stats))
+        dataset['imgs_data'] = imgs_data
+        dataset['imgs_data_baseline'] = imgs_data[:len(subjects)]
+        dataset['imgs_offsets'] = offsets
+        dataset['imgs_data_scale'] = stats[:, 0]
+        dataset['imgs_data_min'] = stats[:, 1]
+        dataset['imgs_data_error'] = stats[:, 2]
+        dataset['imgs_data_rmse'] = stats[:, 3]
+        dataset['imgs_io'] = Bunch(**io_stats)
+        mask_key = None if mask is None else _get_mask(mask).get('key')
+        if mask is None or mask_key is not None:
+            # cache key of the block, without reading it
+            from joblib import hash as joblib_hash
+            dataset['imgs_data_key'] = joblib_hash(
+                (_fingerprint(img_files), mask_key, quantize))
+
+    if change_features:
+        if modality in ['pet', 'av45']:
+            delta, slope = _block_change_features(
+                dataset.imgs_data, dataset.imgs_data_scale,
+                dataset.imgs_data_min, change_offsets, change_time)
+        else:
+            delta, slope = _change_features(values[baseline_rows],
+                                            values[followup_rows],
+                                            change_time, change_offsets)
+        dataset['change_time'] = change_time
+        dataset['change_delta'] = delta
+        dataset['change_slope'] = slope
+        dataset['change_offsets'] = change_offsets
+    return dataset
+
+
+def iter_imgs_data(dataset, rows=None, chunk_size=256):
+    """ Yields (rows, float32 images) of the imgs_data block
+    of load_longitudinal_dataset by chunks of rows
+    """
+    return _iter_dequantized(dataset.imgs_data, dataset.imgs_data_scale,
+                             dataset.imgs_data_min, rows, chunk_size)
+
+
+def compute_group_stats(dataset, mask=None, img_key='pet', groups=None,
+                        n_jobs=1, verbose=0):
+    """ Returns voxelwise statistics of the images of each dx group
+    (groups of _get_group_indices, composites included), computed in one
+    streaming pass over the image paths, by chunks on n_jobs processes.
+
+    Returns a Bunch group -> Bunch(count, mean, var), var is the
+    population variance (as np.var), mean and var are None for
+    empty groups. Only the bounding box of the mask is read from
+    uncompressed .nii files, the reading statistics are printed if verbose
+    """
+    img_files = np.asarray(dataset[img_key])
+    labels = np.asarray(dataset.dx_group, dtype=object)
+    chunks = np.array_split(np.arange(len(img_files)),
+                            max(1, min(len(img_files), 4 * abs(n_jobs))))
+    if n_jobs == 1:
+        partials = [_accumulate_moments(img_files[c], labels[c], mask)
+                    for c in chunks]
     else:
-        return Bunch(imgs=imgs, imgs_baseline=imgs_baseline,
-                     dx_group=dx_all, dx_group_baseline=dx_group,
-                     subjects=subj, subjects_baseline=subjects,
-                     exams=exams_all, exams_baseline=exams,)
+        from joblib import Parallel, delayed
+        partials = Parallel(n_jobs=n_jobs)(
+            delayed(_accumulate_moments)(img_files[c], labels[c], mask)
+            for c in chunks)
+    partials, io_stats = zip(*partials)
+    if verbose:
+        print(_io_report(_merge_io_stats(io_stats)))
+    moments = _get_group_moments(_merge_label_moments(partials), groups)
+    stats = Bunch()
+    for g, (n, mean, m2) in moments.items():
+        if n == 0:
+            stats[g] = Bunch(count=0, mean=None, var=None)
+        else:
+            stats[g] = Bunch(count=n, mean=mean, var=m2 / n)
+    return stats
+
+
+def get_classification_tasks(dataset, tasks=None, n_iter=None,
+                             test_size=.3, random_state=42):
+    """ Returns a Bunch task name -> Bunch(groups, idx, y, labels) of the
+    classification tasks of a dataset, without copying its features :
+    idx are the rows of the task, y their labels (1 / -1 for two groups,
+    1 ... n for n groups) and labels the labels of all the rows
+    (0 outside the task), so that a classifier is trained on
+    features[train], labels[train].
+    tasks : list of CLASSIFICATION_TASKS names or dict name -> groups,
+            None for all of CLASSIFICATION_TASKS. The groups of a task
+            must not overlap (ValueError), e.g. MCI and EMCI
+    n_iter : if set, adds the stratified subject splits of each task
+             (splits), as rows of the dataset
+    """
+    if tasks is None:
+        tasks = CLASSIFICATION_TASKS
+    if not isinstance(tasks, dict):
+        tasks = dict((name, CLASSIFICATION_TASKS[name]) for name in tasks)
+    all_tasks = Bunch()
+    for name, groups in tasks.items():
+        task = _get_task(dataset.dx_group, groups)
+        if n_iter is not None:
+            task.splits = _get_task_splits(dataset, task, n_iter=n_iter,
+                                           test_size=test_size,
+                                           random_state=random_state)
+        all_tasks[name] = task
+    return all_tasks
+
+
+def compute_gram_matrix(features, chunk_size=256, cache=False):
+    """ Returns the Gram matrix X.X^T of features (float64), computed
+    by chunks of rows so that the features are never fully in memory.
+    features is an array (or memmap) of one row per image, or a dataset
+    of load_longitudinal_dataset with load_imgs (its imgs_data block).
+    If cache, the matrix is cached in the data cache directory, keyed on
+    the images of the dataset (imgs_data_key), on the version of the file
+    of a memmap, or else on the features content.
+    """
+    if isinstance(features, dict):
+        args = (features['imgs_data'], features['imgs_data_scale'],
+                features['imgs_data_min'])
+        key = features.get('imgs_data_key')
+    else:
+        args = (features, None, None)
+        key = None
+    if not cache:
+        return _gram_matrix(*args, chunk_size=chunk_size)
+    if key is None:
+        key = (_array_fingerprint(args[0]),
+               None if args[1] is None else _array_fingerprint(args[1]),
+               None if args[2] is None else _array_fingerprint(args[2]))
+    return _get_memory().call_keyed(key, _gram_matrix, *args,
+                                    chunk_size=chunk_size)
+
+
+def cross_val_score_precomputed(K, labels, splits, clf=None,
+                                n_permutations=0, random_state=42,
+                                n_jobs=1, subjects=None):
+    """ Returns a Bunch of the scores of a precomputed-kernel classifier
+    over splits (lists of [train rows, test rows] of K), the cost of
+    each fold does not depend on the number of features.
+    K : Gram matrix (compute_gram_matrix)
+    labels : labels of the rows of K (labels of get_classification_tasks)
+    clf : None for a linear SVC, a classifier with kernel='precomputed'
+    n_permutations : number of label permutations, adds
+                     permutation_scores (mean score of each permutation)
+                     and pvalue
+    subjects : subjects of the rows of K, needed with n_permutations :
+               the label of each subject (of its first row) is permuted
+               among the subjects of the splits and given to all its rows
+    """
+    from joblib import Parallel, delayed
+    if clf is None:
+        from sklearn.svm import SVC
+        clf = SVC(kernel='precomputed')
+    from sklearn.base import clone
+    labels = np.asarray(labels)
+    if n_permutations and subjects is None:
+        raise ValueError('subjects are needed with n_permutations')
+
+    def score(y):
+        return np.array(Parallel(n_jobs=n_jobs)(
+            delayed(_train_and_score_precomputed)(clone(clf), K, y,
+                                                  train, test)
+            for train, test in splits))
+
+    results = Bunch(scores=score(labels))
+    if n_permutations:
+        rows = np.unique(np.hstack([np.hstack(split) for split in splits]))
+        _, first, inverse = np.unique(np.asarray(subjects)[rows],
+                                      return_index=True, return_inverse=True)
+        subject_labels = labels[rows[first]]
+        rng = np.random.RandomState(random_state)
+        permutation_scores = np.empty(n_permutations)
+        for p in range(n_permutations):
+            y = labels.copy()
+            y[rows] = subject_labels[rng.permutation(len(first))][inverse]
+            permutation_scores[p] = score(y).mean()
+        results.permutation_scores = permutation_scores
+        results.pvalue = ((np.sum(permutation_scores >=
+                                  results.scores.mean()) + 1.) /
+                          (n_permutations + 1))
+    return results
 
 
 def get_scores_adnidod(subjects):
@@ -799,33 +1360,31 @@ def get_scores_adnidod(subjects):
     BASE_DIR = _get_data_base_dir('ADNIDOD_csv')
 
     # meta-data
-    demog = pd.read_csv(os.path.join(BASE_DIR, 'PTDEMOG.csv'))
-    mmse = pd.read_csv(os.path.join(BASE_DIR, 'MMSE.csv'))
-    cdr = pd.read_csv(os.path.join(BASE_DIR, 'CDR.csv'))
-    gdscale = pd.read_csv(os.path.join(BASE_DIR, 'GDSCALE.csv'))
-    faq = pd.read_csv(os.path.join(BASE_DIR, 'FAQ.csv'))
-    npiq = pd.read_csv(os.path.join(BASE_DIR, 'NPI.csv'))
-    adas = pd.read_csv(os.path.join(BASE_DIR, 'ADAS.csv'))
-    neurobat = pd.read_csv(os.path.join(BASE_DIR, 'NEUROBAT.csv'))
-
-    def get_score(subj_id, score, score_file, ptid='SCRNO'):
-        m = score_file[score_file[ptid] == int(subj_id)][score].dropna().values
-        if len(m) > 0:
-            m[m < 0] = 0
-            return np.median(m)
-        else:
-            return 0.
+    demog = _read_csv(os.path.join(BASE_DIR, 'PTDEMOG.csv'),
+                      ['SCRNO', 'PTAGE'])
+    mmse = _read_csv(os.path.join(BASE_DIR, 'MMSE.csv'), ['SCRNO', 'MMSCORE'])
+    cdr = _read_csv(os.path.join(BASE_DIR, 'CDR.csv'), ['SCRNO', 'CDGLOBAL'])
+    gdscale = _read_csv(os.path.join(BASE_DIR, 'GDSCALE.csv'),
+                        ['SCRNO', 'GDTOTAL'])
+    faq = _read_csv(os.path.join(BASE_DIR, 'FAQ.csv'), ['SCRNO', 'FAQTOTAL'])
+    npiq = _read_csv(os.path.join(BASE_DIR, 'NPI.csv'), ['SCRNO', 'NPITOTAL'])
+    adas = _read_csv(os.path.join(BASE_DIR, 'ADAS.csv'),
+                     ['SCRNO', 'TOTSCORE', 'TOTAL13'])
+    neurobat = _read_csv(os.path.join(BASE_DIR, 'NEUROBAT.csv'),
+                         ['SCRNO', 'LDELTOTAL', 'LIMMTOTAL'])
 
     df = {'subjects': subjects}
-    keys = ['mmse', 'cdr', 'gdscale', 'faq', 'npiq', 'adas1', 'adas2',
-            'ldel', 'limm', 'age']
-    scores = ['MMSCORE', 'CDGLOBAL', 'GDTOTAL', 'FAQTOTAL', 'NPITOTAL',
-              'TOTSCORE', 'TOTAL13', 'LDELTOTAL', 'LIMMTOTAL', 'PTAGE']
-    score_files = [mmse, cdr, gdscale, faq, npiq, adas, adas, neurobat,
-                   neurobat, demog]
+    keys = [['mmse'], ['cdr'], ['gdscale'], ['faq'], ['npiq'],
+            ['adas1', 'adas2'], ['ldel', 'limm'], ['age']]
+    scores = [['MMSCORE'], ['CDGLOBAL'], ['GDTOTAL'], ['FAQTOTAL'],
+              ['NPITOTAL'], ['TOTSCORE', 'TOTAL13'],
+              ['LDELTOTAL', 'LIMMTOTAL'], ['PTAGE']]
+    score_files = [mmse, cdr, gdscale, faq, npiq, adas, neurobat, demog]
+    # clamped medians of all the subjects, one grouped pass per table
     for k, s, sf in zip(keys, scores, score_files):
-        sc = [get_score(subj, s, sf) for subj in subjects]
-        df[k] = np.array(sc)
+        medians = _get_median_scores(sf, s, subjects)
+        for key, score in zip(k, s):
+            df[key] = medians[score].values
     return df
 
 
@@ -834,46 +1393,23 @@ def get_ptsd_adnidod(subjects):
     BASE_DIR = _get_data_base_dir('ADNIDOD_csv')
 
     # meta-data
-    caps_curr = pd.read_csv(os.path.join(BASE_DIR, 'CAPSLIFE.csv'))
-    caps_life = pd.read_csv(os.path.join(BASE_DIR, 'CAPSCURR.csv'))
-
-    def get_caps(subj_id, score, score_file, ptid='SCRNO'):
-        m = score_file[score_file[ptid] == int(subj_id)][score].dropna().values
-        if len(m) > 0:
-            m[m < 0] = 0
-            return np.median(m)
-        else:
-            return 0.
-
-    def get_ptsd(caps_curr, caps_life, threshold=45):
-        # 0: normal, 1: ptsd, 2: past ptsd
-        if caps_curr >= threshold:
-            if caps_life >= threshold:
-                # ptsd
-                ptsd_status = 1
-            else:
-                # aberrant
-                ptsd_status = 0
-        else:
-            if caps_life >= threshold:
-                # ptsd in the past
-                ptsd_status = 2
-            else:
-                # normal
-                ptsd_status = 0
-        return ptsd_status
+    caps_curr = _read_csv(os.path.join(BASE_DIR, 'CAPSCURR.csv'),
+                          ['SCRNO', 'CAPSSCORE'])
+    caps_life = _read_csv(os.path.join(BASE_DIR, 'CAPSLIFE.csv'),
+                          ['SCRNO', 'CAPSSCORE'])
 
     df = {}
-    keys = {'caps_life', 'caps_curr'}
-    scores = ['CAPSSCORE', 'CAPSSCORE']
+    keys = ['caps_life', 'caps_curr']
     score_files = [caps_life, caps_curr]
-
-    for k, s, sf in zip(keys, scores, score_files):
-        sc = [get_caps(subj, s, sf) for subj in subjects]
-        df[k] = np.array(sc)
-    ptsd = [get_ptsd(cc, cl)
-            for cc, cl in zip(df['caps_curr'], df['caps_life'])]
-    df['dx_group'] = np.array(ptsd)
+    for k, sf in zip(keys, score_files):
+        df[k] = _get_median_scores(sf, ['CAPSSCORE'],
+                                   subjects)['CAPSSCORE'].values
+
+    # 0: normal (or aberrant), 1: ptsd, 2: past ptsd
+    threshold = 45
+    life = df['caps_life'] >= threshold
+    curr = df['caps_curr'] >= threshold
+    df['dx_group'] = np.select([curr & life, ~curr & life], [1, 2], 0)
     return df
 
 
@@ -889,19 +1425,20 @@ def load_adnidod_rs_fmri():
     func_files = np.array(func_files)
     scores = get_scores_adnidod(subjects)
     ptsd = get_ptsd_adnidod(subjects)
-    return Bunch(func=func_files,
-                 subjects=subjects,
-                 npiq=scores['npiq'],
-                 mmse=scores['mmse'],
-                 ldel=scores['ldel'],
-                 age=scores['age'],
-                 faq=scores['faq'],
-                 cdr=scores['cdr'],
-                 limm=scores['limm'],
-                 adas1=scores['adas1'],
-                 adas2=scores['adas2'],
-                 gdscale=scores['gdscale'],
-                 ptsd=ptsd,)
+    dataset = Bunch(func=func_files,
+                    subjects=subjects,
+                    npiq=scores['npiq'],
+                    mmse=scores['mmse'],
+                    ldel=scores['ldel'],
+                    age=scores['age'],
+                    faq=scores['faq'],
+                    cdr=scores['cdr'],
+                    limm=scores['limm'],
+                    adas1=scores['adas1'],
+                    adas2=scores['adas2'],
+                    gdscale=scores['gdscale'],
+                    ptsd=ptsd,)
+    return _encode_dataset(dataset)
 
 
 def load_adnidod_av45_pet():
@@ -916,15 +1453,16 @@ def load_adnidod_av45_pet():
                      subject_paths))
     pet = np.array(func_files)
     scores = get_scores_adnidod(subjects)
-    return Bunch(pet=pet,
-                 subjects=subjects,
-                 npiq=scores['npiq'],
-                 mmse=scores['mmse'],
-                 ldel=scores['ldel'],
-                 age=scores['age'],
-                 faq=scores['faq'],
-                 cdr=scores['cdr'],
-                 limm=scores['limm'],
-                 adas1=scores['adas1'],
-                 adas2=scores['adas2'],
-                 gdscale=scores['gdscale'],)
+    dataset = Bunch(pet=pet,
+                    subjects=subjects,
+                    npiq=scores['npiq'],
+                    mmse=scores['mmse'],
+                    ldel=scores['ldel'],
+                    age=scores['age'],
+                    faq=scores['faq'],
+                    cdr=scores['cdr'],
+                    limm=scores['limm'],
+                    adas1=scores['adas1'],
+                    adas2=scores['adas2'],
+                    gdscale=scores['gdscale'],)
+    return _encode_dataset(dataset)
@@ -0,0 +1,202 @@
+"""
+Cache of images resampled to atlas or template grids.
+
+A resampled image is stored as an uncompressed nifti file named after the
+hash of (image fingerprint, target shape, target affine, interpolation) :
+- an image already on the target grid is returned as it is,
+- a cached image is reused by every job sharing the cache directory,
+- a missing image is resampled once : the first process takes a lock file
+  next to it, the others wait for it (the holder touches its lock, a lock
+  not touched for lock_timeout seconds is considered left by a crashed
+  worker and is broken),
+- the cache directory is bounded in size, least recently used images are
+  evicted first, but never the images of the current batch nor the images
+  used by any job in the last RESAMPLING_CACHE_GRACE seconds (the cache
+  may exceed its size until they age).
+
+The cache directory is set by the DATASET_LOADER_RESAMPLING_CACHE
+environment variable and its size in megabytes by
+DATASET_LOADER_RESAMPLING_CACHE_SIZE.
+"""
+import os
+import time
+import threading
+import numpy as np
+from dataset_loader.utils import _get_cache_base_dir
+from dataset_loader.cache import (_acquire_lock, _release_lock,
+                                  _break_stale_lock, _evict_lru,
+                                  _heartbeat, LOCK_TIMEOUT)
+from dataset_loader.snapshot import _fingerprint
+
+RESAMPLING_CACHE_SIZE = 10240
+RESAMPLING_CACHE_GRACE = 3600
+
+
+def _get_resampling_cache_dir():
+    """ Returns the directory of the resampled images
+    """
+    cache_dir = os.environ.get('DATASET_LOADER_RESAMPLING_CACHE')
+    if not cache_dir:
+        cache_dir = os.path.join(_get_cache_base_dir(), 'dataset_loader',
+                                 'resampling_cache')
+    return cache_dir
+
+
+def _get_target(target, target_shape=None):
+    """ Returns (shape, affine) of the target grid,
+    target is an image or an affine (then target_shape is needed)
+    """
+    if isinstance(target, str) or hasattr(target, 'affine'):
+        import nibabel as nib
+        img = nib.load(target) if isinstance(target, str) else target
+        return tuple(int(n) for n in img.shape[:3]), np.asarray(img.affine)
+    if target_shape is None:
+        raise ValueError('target_shape is needed with a target affine')
+    return tuple(int(n) for n in target_shape), np.asarray(target)
+
+
+def _resampling_key(img_file, shape, affine, interpolation):
+    """ Returns the cache key of an image resampled to a grid
+    """
+    import joblib
+    # the affine is rounded so that equal grids read from different
+    # headers share their images
+    return joblib.hash((_fingerprint([img_file])[0], shape,
+                        np.round(affine, 6).tolist(), interpolation))
+
+
+def _on_grid(img, shape, affine):
+    """ True if img is already on the grid
+    """
+    return (tuple(img.shape[:3]) == shape and
+            np.allclose(img.affine, affine, atol=1e-6))
+
+
+def _resampled_size(img_file, shape, affine, interpolation):
+    """ Returns the expected size in bytes of an image resampled to the
+    grid, 0 if it is already on the grid
+    """
+    import nibabel as nib
+    img = nib.load(img_file)
+    if _on_grid(img, shape, affine):
+        return 0
+    itemsize = 4
+    if interpolation == 'nearest':
+        itemsize = img.get_data_dtype().itemsize
+    return int(np.prod(shape + tuple(img.shape[3:]))) * itemsize + 352
+
+
+def _resample_to_file(img_file, path, shape, affine, interpolation):
+    """ Resamples img_file to the grid and writes it to path
+    """
+    import nibabel as nib
+    from nilearn.image import resample_img
+    img = resample_img(img_file, target_affine=affine, target_shape=shape,
+                       interpolation=interpolation)
+    if interpolation != 'nearest':
+        # labels keep their dtype, intensities are stored as float32
+        img = nib.Nifti1Image(img.get_fdata(dtype=np.float32), img.affine)
+    tmp = '%s.%d.%d.tmp.nii' % (path[:-4], os.getpid(),
+                                threading.current_thread().ident)
+    try:
+        nib.save(img, tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _resample_cached(img_file, shape, affine, interpolation, cache_dir,
+                     lock_timeout=LOCK_TIMEOUT):
+    """ Returns the path of img_file resampled to the grid,
+    resampled by a single process
+    """
+    import nibabel as nib
+    if _on_grid(nib.load(img_file), shape, affine):
+        return img_file
+
+    key = _resampling_key(img_file, shape, affine, interpolation)
+    path = os.path.join(cache_dir, '%s.nii' % key)
+    lock_path = path + '.lock'
+    delay = .05
+    while True:
+        if os.path.exists(path):
+            # mtime tracks the last use for the eviction
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+            return path
+        if _acquire_lock(lock_path):
+            try:
+                # the image may have been written before the lock
+                if not os.path.exists(path):
+                    with _heartbeat(lock_path, lock_timeout):
+                        _resample_to_file(img_file, path, shape, affine,
+                                          interpolation)
+                return path
+            finally:
+                _release_lock(lock_path)
+        # another process resamples the image
+        _break_stale_lock(lock_path, lock_timeout)
+        time.sleep(delay)
+        delay = min(2 * delay, 1.)
+
+
+def resample_imgs(imgs, target, target_shape=None,
+                  interpolation='continuous', n_jobs=1, cache_dir=None,
+                  cache_size=None):
+    """ Returns the paths of the images resampled to the target grid,
+    resampled images are cached on disk and shared across jobs.
+
+    Parameters
+    ----------
+    imgs : list of image paths
+    target : image path (atlas, template) or target affine
+    target_shape : target shape, needed with a target affine
+    interpolation : 'continuous', 'linear' or 'nearest' (for label images)
+    n_jobs : number of processes resampling the images
+    cache_dir : None for DATASET_LOADER_RESAMPLING_CACHE
+                (default in the cache directory)
+    cache_size : size bound of the cache in megabytes,
+                 None for DATASET_LOADER_RESAMPLING_CACHE_SIZE
+                 (default 10240), a batch which does not fit in it
+                 raises a ValueError
+    """
+    from joblib import Parallel, delayed
+    if cache_dir is None:
+        cache_dir = _get_resampling_cache_dir()
+    if cache_size is None:
+        cache_size = float(os.environ.get(
+            'DATASET_LOADER_RESAMPLING_CACHE_SIZE', RESAMPLING_CACHE_SIZE))
+    os.makedirs(cache_dir, exist_ok=True)
+    shape, affine = _get_target(target, target_shape)
+
+    img_files, inverse = np.unique(np.asarray(imgs, dtype=str),
+                                   return_inverse=True)
+    cache_size = int(cache_size * 1024 ** 2)
+    batch_size = sum(_resampled_size(img_file, shape, affine, interpolation)
+                     for img_file in img_files)
+    if batch_size > cache_size:
+        raise ValueError('The resampled images (%.1f MB) do not fit in the '
+                         'resampling cache (%.1f MB)' %
+                         (batch_size / 1024. ** 2, cache_size / 1024. ** 2))
+    paths = Parallel(n_jobs=n_jobs)(
+        delayed(_resample_cached)(img_file, shape, affine, interpolation,
+                                  cache_dir)
+        for img_file in img_files)
+    # the images of this batch and the ones just used by other jobs stay
+    _evict_lru(cache_dir, cache_size, keep=paths,
+               min_age=RESAMPLING_CACHE_GRACE)
+    return np.array(paths)[inverse.ravel()]
+
+
+def resample_img(img, target, target_shape=None, interpolation='continuous',
+                 cache_dir=None, cache_size=None):
+    """ Returns the path of an image resampled to the target grid,
+    see resample_imgs
+    """
+    return resample_imgs([img], target, target_shape=target_shape,
+                         interpolation=interpolation, cache_dir=cache_dir,
+                         cache_size=cache_size)[0]
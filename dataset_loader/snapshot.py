@@ -0,0 +1,262 @@
+"""
+Single-file dataset snapshots.
+
+A snapshot stores the fields of a dataset in one file : a json header
+followed by aligned raw blocks which are memory-mapped on load.
+- numerical and date arrays are stored as they are,
+- string columns and categoricals are stored as integer codes,
+  their categories are kept in the header (missing strings, None or NaN,
+  are loaded as None),
+- ragged fields (one array per subject) are stored as their concatenated
+  values and offsets,
+- scalars and None are kept in the header, dates as ISO strings,
+- nested Bunches are stored field by field.
+The files and directories the dataset was built from are fingerprinted,
+a snapshot which does not match them anymore is refused on load. They are
+recorded while the dataset is loaded :
+
+    with record_sources() as sources:
+        dataset = load_adni_longitudinal_fdg_pet()
+    save_dataset_snapshot(dataset, 'fdg.snap', sources)
+"""
+import os
+import json
+import time
+import numpy as np
+from dataset_loader.utils import Bunch, _LazyModule, _record_sources
+
+pd = _LazyModule('pandas')
+
+SNAPSHOT_MAGIC = b'DLSNAP'
+SNAPSHOT_VERSION = 1
+# blocks are aligned so that memory-mapped views are aligned for any dtype
+SNAPSHOT_ALIGN = 64
+
+
+class _BlockWriter(object):
+    """ Appends aligned raw blocks and returns their specs
+    """
+    def __init__(self):
+        self.blocks = []
+        self.size = 0
+
+    def add(self, values):
+        values = np.ascontiguousarray(values)
+        offset = -self.size % SNAPSHOT_ALIGN + self.size
+        self.blocks.append((offset, values))
+        self.size = offset + values.nbytes
+        return dict(dtype=values.dtype.str, shape=list(values.shape),
+                    offset=offset)
+
+
+def _fingerprint(sources):
+    """Returns [path, size, mtime] of each source file or directory
+    """
+    fingerprints = []
+    for source in sources:
+        stat = os.stat(source)
+        fingerprints.append([os.path.abspath(source),
+                             stat.st_size, stat.st_mtime])
+    return fingerprints
+
+
+def record_sources():
+    """ Context manager yielding the list of the files and directories
+    (clinical tables, image descriptions and directories) read by the
+    loaders called in the block, in this thread and in the workers of
+    load_multimodal_datasets
+    """
+    return _record_sources()
+
+
+def _is_ragged(values):
+    """ True for a list or object array of arrays
+    """
+    if isinstance(values, np.ndarray) and values.dtype != object:
+        return False
+    return (len(values) > 0 and
+            all(isinstance(v, (np.ndarray, list, tuple)) for v in values))
+
+
+def _encode_strings(values, writer):
+    """ Returns the spec of a string array stored as codes, its missing
+    values (None or NaN) are coded -1
+    """
+    values = np.asarray(values)
+    flat = values.ravel()
+    if values.dtype == object and not all(
+            v is None or isinstance(v, str) or
+            (isinstance(v, float) and np.isnan(v)) for v in flat):
+        raise TypeError('Unsupported object values')
+    codes, categories = pd.factorize(flat, sort=True)
+    spec = dict(kind='strings', dtype=values.dtype.str,
+                categories=[str(c) for c in categories],
+                codes=writer.add(codes.astype(np.int32).reshape(values.shape)))
+    return spec
+
+
+def _encode_field(values, writer):
+    """ Returns the spec of a dataset field, its blocks are added to writer
+    """
+    if values is None or isinstance(values, (str, bool, int, float)):
+        return dict(kind='scalar', value=values)
+    if isinstance(values, np.datetime64):
+        unit = np.datetime_data(values.dtype)[0]
+        return dict(kind='datetime', unit=unit,
+                    value=np.datetime_as_string(values, unit=unit))
+    if isinstance(values, np.timedelta64):
+        return dict(kind='timedelta', unit=np.datetime_data(values.dtype)[0],
+                    value=int(values.astype(np.int64)))
+    if isinstance(values, (np.generic,)):
+        return dict(kind='scalar', value=values.item())
+    if isinstance(values, dict):
+        return dict(kind='bunch',
+                    fields=dict((k, _encode_field(v, writer))
+                                for k, v in values.items()))
+    if isinstance(values, pd.Categorical):
+        return dict(kind='categorical',
+                    categories=np.asarray(values.categories).tolist(),
+                    codes=writer.add(values.codes.astype(np.int32)))
+    if _is_ragged(values):
+        parts = [np.asarray(v) for v in values]
+        lengths = np.array([len(p) for p in parts], dtype=np.int64)
+        offsets = np.hstack(([0], np.cumsum(lengths)))
+        return dict(kind='ragged', offsets=writer.add(offsets),
+                    values=_encode_field(np.concatenate(parts), writer))
+    values = np.asarray(values)
+    if values.dtype.kind in 'biufcmMS':
+        return dict(kind='array', array=writer.add(values))
+    if values.dtype.kind in 'UO':
+        return _encode_strings(values, writer)
+    raise TypeError('Unsupported dtype %s' % values.dtype)
+
+
+def _decode_block(buf, spec):
+    """ Returns a memory-mapped view of a block
+    """
+    dtype = np.dtype(spec['dtype'])
+    shape = tuple(spec['shape'])
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    if nbytes == 0:
+        return np.empty(shape, dtype=dtype)
+    offset = spec['offset']
+    return buf[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
+def _decode_field(buf, spec):
+    """ Returns the values of a dataset field from its spec
+    """
+    kind = spec['kind']
+    if kind == 'scalar':
+        return spec['value']
+    if kind == 'datetime':
+        return np.datetime64(spec['value'], spec['unit'])
+    if kind == 'timedelta':
+        return np.timedelta64(spec['value'], spec['unit'])
+    if kind == 'array':
+        return _decode_block(buf, spec['array'])
+    if kind == 'bunch':
+        return Bunch(**dict((k, _decode_field(buf, v))
+                            for k, v in spec['fields'].items()))
+    if kind == 'categorical':
+        return pd.Categorical.from_codes(_decode_block(buf, spec['codes']),
+                                         spec['categories'])
+    if kind == 'strings':
+        # missing values (code -1) take the last category : None
+        categories = np.array(spec['categories'] + [None], dtype=object)
+        values = categories[_decode_block(buf, spec['codes'])]
+        dtype = np.dtype(spec['dtype'])
+        return values if dtype == object else values.astype(dtype)
+    if kind == 'ragged':
+        values = _decode_field(buf, spec['values'])
+        offsets = _decode_block(buf, spec['offsets'])
+        ragged = np.empty(len(offsets) - 1, dtype=object)
+        for i in range(len(ragged)):
+            ragged[i] = values[offsets[i]:offsets[i + 1]]
+        return ragged
+    raise ValueError('Unknown field kind %s' % kind)
+
+
+def save_dataset_snapshot(dataset, filename, sources):
+    """ Saves a dataset to a single snapshot file
+
+    Parameters
+    ----------
+    dataset : Bunch returned by a loader
+    filename : path of the snapshot
+    sources : files or directories the dataset was built from
+              (recorded with record_sources while loading it)
+    """
+    writer = _BlockWriter()
+    fields = {}
+    for k in dataset.keys():
+        try:
+            fields[k] = _encode_field(dataset[k], writer)
+        except TypeError as e:
+            raise TypeError('Cannot snapshot field %s : %s' % (k, e))
+    header = json.dumps(dict(version=SNAPSHOT_VERSION,
+                             created=time.strftime('%Y-%m-%d %H:%M:%S'),
+                             sources=_fingerprint(sources),
+                             fields=fields)).encode('utf-8')
+    # magic, header length, header, padding up to the first block
+    start = len(SNAPSHOT_MAGIC) + 8 + len(header)
+    start += -start % SNAPSHOT_ALIGN
+    tmp = '%s.tmp%d' % (filename, os.getpid())
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(np.array(len(header), dtype='<u8').tobytes())
+            f.write(header)
+            for offset, values in writer.blocks:
+                f.seek(start + offset)
+                f.write(values.tobytes())
+            f.truncate(start + writer.size)
+        # readers never see a partially written snapshot
+        os.replace(tmp, filename)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def _read_snapshot_header(filename):
+    """ Returns the header of a snapshot and the offset of its blocks
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise ValueError('%s is not a dataset snapshot' % filename)
+        length = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        header = json.loads(f.read(length).decode('utf-8'))
+    start = len(SNAPSHOT_MAGIC) + 8 + length
+    start += -start % SNAPSHOT_ALIGN
+    return header, start
+
+
+def load_dataset_snapshot(filename, check_sources=True):
+    """ Loads a dataset saved with save_dataset_snapshot.
+    Arrays are read-only memory-mapped views of the snapshot.
+
+    Parameters
+    ----------
+    filename : path of the snapshot
+    check_sources : raise a ValueError if a source file or directory
+                    changed since the snapshot was saved
+    """
+    header, start = _read_snapshot_header(filename)
+    if header['version'] != SNAPSHOT_VERSION:
+        raise ValueError('Snapshot version %s is not supported (%s)' %
+                         (header['version'], SNAPSHOT_VERSION))
+    if check_sources:
+        for path, size, mtime in header['sources']:
+            if (not os.path.exists(path) or
+                    _fingerprint([path])[0] != [path, size, mtime]):
+                raise ValueError('Snapshot %s is stale : %s changed' %
+                                 (filename, path))
+    if os.path.getsize(filename) > start:
+        buf = np.memmap(filename, dtype=np.uint8, mode='r', offset=start)
+    else:
+        buf = np.empty(0, dtype=np.uint8)
+    dataset = Bunch()
+    for k, spec in header['fields'].items():
+        dataset[k] = _decode_field(buf, spec)
+    return dataset
@@ -0,0 +1,75 @@
+import os
+import sys
+import time
+import importlib
+import numpy as np
+from dataset_loader import cache
+from dataset_loader.cache import TwoTierMemory
+
+
+def _import_module(tmp_path, source, name='cached_module'):
+    (tmp_path / ('%s.py' % name)).write_text(source)
+    sys.path.insert(0, str(tmp_path))
+    try:
+        sys.modules.pop(name, None)
+        importlib.invalidate_caches()
+        return importlib.import_module(name)
+    finally:
+        sys.path.remove(str(tmp_path))
+        sys.modules.pop(name, None)
+
+
+def test_key_ignores_function_position(tmp_path):
+    memory = TwoTierMemory(str(tmp_path / 'shared'), local_dir='')
+    source = 'def f(x):\n    return x + 1\n'
+    key = memory._get_key(_import_module(tmp_path, source).f, (1,), {})
+    moved = _import_module(tmp_path, '\n\n# moved\n' + source)
+    assert memory._get_key(moved.f, (1,), {}) == key
+    changed = _import_module(tmp_path, source.replace('1', '2'))
+    assert memory._get_key(changed.f, (1,), {}) != key
+
+
+def test_local_size_tracking(tmp_path, monkeypatch):
+    walks = []
+    evict_lru = cache._evict_lru
+    monkeypatch.setattr(cache, '_evict_lru',
+                        lambda *args: walks.append(1) or evict_lru(*args))
+    local_dir = str(tmp_path / 'local')
+    memory = TwoTierMemory(str(tmp_path / 'shared'), local_dir=local_dir,
+                           local_size=.4)
+    for i in range(3):
+        memory.call(np.full, 20000, i, dtype=np.float64)
+    # the first write counts the local tier, the third one exceeds it
+    assert len(walks) == 2
+    sizes = [os.path.getsize(os.path.join(root, f))
+             for root, _, files in os.walk(local_dir) for f in files]
+    assert sum(sizes) <= .4 * 1024 ** 2
+    assert cache._LOCAL_SIZES[local_dir][0] == sum(sizes)
+
+
+def _count_call(counter_file, x):
+    with open(counter_file, 'a') as f:
+        f.write('%d\n' % os.getpid())
+    # longer than the lock timeout : the heartbeat keeps the lock
+    time.sleep(1.5)
+    return 2 * x
+
+
+def _call_counted(shared_dir, counter_file):
+    memory = TwoTierMemory(shared_dir, local_dir='', lock_timeout=.4)
+    return memory.call(_count_call, counter_file, 3)
+
+
+def test_concurrent_misses_computed_once(tmp_path):
+    import multiprocessing
+    counter_file = str(tmp_path / 'counter.txt')
+    pool = multiprocessing.get_context('spawn').Pool(6)
+    try:
+        results = pool.starmap(_call_counted,
+                               [(str(tmp_path / 'shared'), counter_file)] * 6)
+    finally:
+        pool.close()
+        pool.join()
+    assert results == [6] * 6
+    with open(counter_file) as f:
+        assert len(f.readlines()) == 1
@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from sklearn.base import BaseEstimator, ClassifierMixin
+from dataset_loader.dataset import cross_val_score_precomputed
+
+_FITTED_LABELS = []
+
+
+class _LabelRecorder(BaseEstimator, ClassifierMixin):
+    def fit(self, K, y):
+        _FITTED_LABELS.append(np.array(y))
+        return self
+
+    def predict(self, K):
+        return np.zeros(len(K))
+
+
+def test_permutations_per_subject():
+    subjects = np.repeat(np.arange(10), 3)
+    labels = np.where(subjects < 5, 1, -1)
+    rows = np.arange(len(subjects))
+    splits = [[rows[subjects % 2 == 0], rows[subjects % 2 == 1]],
+              [rows[subjects % 2 == 1], rows[subjects % 2 == 0]]]
+    K = np.eye(len(subjects))
+    with pytest.raises(ValueError):
+        cross_val_score_precomputed(K, labels, splits, n_permutations=2)
+    del _FITTED_LABELS[:]
+    results = cross_val_score_precomputed(
+        K, labels, splits, clf=_LabelRecorder(), n_permutations=5,
+        subjects=subjects)
+    assert len(results.permutation_scores) == 5
+    for p in range(5):
+        # the two train sets cover the subjects, each with one label
+        y = np.hstack(_FITTED_LABELS[2 + 2 * p:4 + 2 * p]).reshape(-1, 3)
+        assert (y == y[:, :1]).all()
+        assert sorted(y[:, 0]) == sorted(labels[::3])
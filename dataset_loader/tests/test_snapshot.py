@@ -0,0 +1,69 @@
+import os
+import numpy as np
+import pytest
+from dataset_loader.utils import Bunch, _read_csv
+from dataset_loader.snapshot import (save_dataset_snapshot,
+                                     load_dataset_snapshot, record_sources)
+
+
+def test_snapshot_datetime_scalars(tmp_path):
+    dataset = Bunch(exam_date=np.datetime64('2010-01-02'),
+                    missing_date=np.datetime64('NaT', 'D'),
+                    gap=np.timedelta64(30, 'D'),
+                    exam_dates=np.array(['2010-01-02', 'NaT'],
+                                        dtype='datetime64[D]'))
+    filename = str(tmp_path / 'dataset.snap')
+    save_dataset_snapshot(dataset, filename, [])
+    loaded = load_dataset_snapshot(filename)
+    assert loaded.exam_date == dataset.exam_date
+    assert np.isnat(loaded.missing_date)
+    assert loaded.gap == dataset.gap
+    np.testing.assert_array_equal(loaded.exam_dates, dataset.exam_dates)
+
+
+def test_snapshot_recorded_sources(tmp_path):
+    table = tmp_path / 'table.csv'
+    table.write_text('RID,MMSCORE\n1,28\n2,30\n')
+    other = tmp_path / 'other.csv'
+    other.write_text('RID,MMSCORE\n1,20\n')
+    _read_csv(str(other), ['RID', 'MMSCORE'])
+    with record_sources() as sources:
+        values = _read_csv(str(table), ['RID', 'MMSCORE'])
+    # only the tables read for this dataset are sources
+    assert sources == [str(table)]
+
+    filename = str(tmp_path / 'dataset.snap')
+    save_dataset_snapshot(Bunch(mmse=values['MMSCORE'].values), filename,
+                          sources)
+    other.write_text('RID,MMSCORE\n1,21\n')
+    load_dataset_snapshot(filename)
+    table.write_text('RID,MMSCORE\n1,28\n2,29\n')
+    with pytest.raises(ValueError):
+        load_dataset_snapshot(filename)
+
+
+def test_snapshot_missing_strings(tmp_path):
+    dataset = Bunch(dx_conv=np.array(['AD', np.nan, None, 'MCI'],
+                                     dtype=object))
+    filename = str(tmp_path / 'dataset.snap')
+    save_dataset_snapshot(dataset, filename, [])
+    loaded = load_dataset_snapshot(filename)
+    assert loaded.dx_conv.tolist() == ['AD', None, None, 'MCI']
+
+
+def test_recorded_sources_threads(tmp_path, monkeypatch):
+    from dataset_loader import dataset as dataset_module
+    tables = []
+    for name in ['pet', 'csf']:
+        table = tmp_path / ('%s.csv' % name)
+        table.write_text('RID,MMSCORE\n1,28\n')
+        tables.append(str(table))
+        monkeypatch.setitem(
+            dataset_module.MODALITY_LOADERS, name,
+            lambda table=str(table): Bunch(mmse=_read_csv(
+                table, ['RID', 'MMSCORE'])['MMSCORE'].values))
+    with record_sources() as sources:
+        datasets = dataset_module.load_multimodal_datasets(
+            ['pet', 'csf'], n_jobs=2, backend='threading')
+    assert sorted(datasets.keys()) == ['csf', 'pet']
+    assert sorted(sources) == sorted(tables)
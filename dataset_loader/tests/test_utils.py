@@ -0,0 +1,205 @@
+import copy
+import pickle
+import numpy as np
+import pandas as pd
+from dataset_loader.utils import (Bunch, DatasetView, _get_change_times,
+                                  _get_task, _get_classification_data,
+                                  _accumulate_moments, _get_group_moments,
+                                  _quantize, _dequantize, UINT16_NAN,
+                                  _read_csv, _array_fingerprint,
+                                  StratifiedSubjectShuffleSplit,
+                                  _get_group_indices, _get_group_masks)
+
+
+def _make_dataset(n=6):
+    return Bunch(subjects=np.array(['s%d' % (i // 2) for i in range(n)]),
+                 dx_group=np.array(['AD', 'AD', 'MCI', 'MCI', 'Normal',
+                                    'Normal'][:n]),
+                 ages=np.arange(n, dtype=float))
+
+
+def test_dataset_view_pickle():
+    view = DatasetView(_make_dataset(), [1, 3, 4])
+    view.extra = np.ones(3)
+    restored = pickle.loads(pickle.dumps(view))
+    assert isinstance(restored, Bunch)
+    assert sorted(restored.keys()) == sorted(view.keys())
+    np.testing.assert_array_equal(restored.ages, [1., 3., 4.])
+    np.testing.assert_array_equal(restored.extra, np.ones(3))
+
+
+def test_dataset_view_copy():
+    dataset = _make_dataset()
+    view = DatasetView(dataset, [0, 2])
+    view_copy = copy.copy(view)
+    assert isinstance(view_copy, DatasetView)
+    view_copy.ages = np.zeros(2)
+    np.testing.assert_array_equal(view.ages, [0., 2.])
+    np.testing.assert_array_equal(dataset.ages, np.arange(6.))
+    view_copy = copy.deepcopy(view)
+    np.testing.assert_array_equal(view_copy.ages, [0., 2.])
+
+
+def test_dataset_view_dict():
+    view = DatasetView(_make_dataset(), [5, 0])
+    assert isinstance(view, dict)
+    assert dict(view).keys() == set(['subjects', 'dx_group', 'ages'])
+    assert Bunch(**view).dx_group.tolist() == ['Normal', 'AD']
+    assert 'ages' in view and view.get('missing') is None
+    df = pd.DataFrame(view)
+    assert df.shape == (2, 3)
+    assert df['ages'].tolist() == [5., 0.]
+
+
+def test_dataset_view_mutations():
+    dataset = _make_dataset()
+    view = DatasetView(dataset, [1, 2])
+    view_copy = view.copy()
+    assert isinstance(view_copy, DatasetView)
+    assert sorted(view_copy) == sorted(view) and len(view_copy) == 3
+    np.testing.assert_array_equal(view.pop('ages'), [1., 2.])
+    assert 'ages' not in view and 'ages' not in list(view)
+    assert len(view) == 2 and view.pop('ages', None) is None
+    assert view.setdefault('ages', 1.) == 1. and view.ages == 1.
+    del view.dx_group
+    assert sorted(view) == ['ages', 'subjects']
+    assert sorted(DatasetView(view, [0])) == ['ages', 'subjects']
+    key, values = view.popitem()
+    assert key not in view and len(view) == 1
+    view.clear()
+    assert len(view) == 0 and dict(view) == {}
+    assert sorted(view_copy) == ['ages', 'dx_group', 'subjects']
+    assert sorted(dataset) == ['ages', 'dx_group', 'subjects']
+    np.testing.assert_array_equal(dataset.ages, np.arange(6.))
+
+
+def test_change_times_adnigo_codes():
+    # hippocampus rows : ADNIGO/2 VISCODE (v03, v06, ...) are not months,
+    # times come from the exam dates, else from VISCODE2
+    vcodes = np.array(['v03', 'v06', 'v11', 'v03', 'v06'])
+    vcodes2 = np.array(['bl', 'm06', 'm12', 'bl', 'm12'])
+    exam_dates = np.array(['2010-01-01', 'NaT', '2011-01-01',
+                           '2012-01-01', '2013-01-01'],
+                          dtype='datetime64[D]')
+    baseline_rows = np.array([0, 3])
+    followup_rows = np.array([1, 2, 4])
+    offsets = np.array([0, 2, 3])
+    times = _get_change_times(baseline_rows, followup_rows, offsets,
+                              vcodes2, exam_dates)
+    np.testing.assert_allclose(times, [.5, 365 / 365.25, 366 / 365.25])
+    times = _get_change_times(baseline_rows, followup_rows, offsets,
+                              vcodes2)
+    np.testing.assert_allclose(times, [.5, 1., 1.])
+    assert np.isnan(_get_change_times(baseline_rows, followup_rows,
+                                      offsets, vcodes)).all()
+
+
+def test_multiclass_task_labels():
+    dx_group = np.array(['AD', 'Normal', 'MCI', 'SMC', 'AD', 'EMCI'])
+    task = _get_task(dx_group, ['AD', 'MCI', 'Normal'])
+    outside = np.ones(len(dx_group), dtype=bool)
+    outside[task.idx] = False
+    # no class shares the label of the rows outside the task
+    assert np.flatnonzero(outside).tolist() == [3]
+    assert (task.labels[outside] == 0).all()
+    assert (task.labels[task.idx] != 0).all()
+    np.testing.assert_array_equal(task.labels[task.idx], task.y)
+    assert dx_group[task.labels == 1].tolist() == ['AD', 'AD']
+    assert dx_group[task.labels == 2].tolist() == ['MCI', 'EMCI']
+    assert dx_group[task.labels == 3].tolist() == ['Normal']
+
+
+def test_classification_data_overlapping_groups():
+    dx_group = np.array(['MCI', 'EMCI', 'Normal', 'LMCI'])
+    X = np.arange(8.).reshape(4, 2)
+    X_task, y = _get_classification_data(X, dx_group, ['MCI', 'EMCI'])
+    assert len(X_task) == 4
+    np.testing.assert_array_equal(y, [1, 1, 1, -1])
+
+
+def test_group_moments_missing_labels(tmp_path):
+    import nibabel as nib
+    rng = np.random.RandomState(0)
+    img_files = []
+    for i in range(5):
+        img_file = str(tmp_path / ('img%d.nii' % i))
+        nib.save(nib.Nifti1Image(rng.rand(3, 4, 5), np.eye(4)), img_file)
+        img_files.append(img_file)
+    labels = np.array(['AD', np.nan, 'Normal', None, 'AD'], dtype=object)
+    moments, _ = _accumulate_moments(img_files, labels)
+    assert sorted(moments.keys()) == ['AD', 'Normal']
+    moments[np.nan] = moments['AD']
+    group_moments = _get_group_moments(moments, ['AD', 'Normal'])
+    data = [nib.load(f).get_fdata().ravel() for f in img_files]
+    np.testing.assert_allclose(group_moments['AD'][1],
+                               (data[0] + data[4]) / 2.)
+    assert group_moments['AD'][0] == 2
+    assert group_moments['Normal'][0] == 1
+
+
+def test_quantize_uint16_nan():
+    data = np.array([1., np.nan, 3., 2.])
+    values, scale, data_min = _quantize(data, 'uint16')
+    assert values[1] == UINT16_NAN
+    restored = _dequantize(values, scale, data_min)
+    assert np.isnan(restored[1])
+    np.testing.assert_allclose(restored[[0, 2, 3]], [1., 3., 2.],
+                               rtol=1e-4)
+    values, scale, data_min = _quantize(np.full(3, np.nan), 'uint16')
+    assert np.isnan(_dequantize(values, scale, data_min)).all()
+
+
+def test_read_csv_missing_ids(tmp_path):
+    table = tmp_path / 'table.csv'
+    table.write_text('RID,SCRNO,VISCODE\n1,10,bl\n,11,m06\n3,12,m12\n')
+    df = _read_csv(str(table), ['RID', 'SCRNO', 'VISCODE'])
+    assert df['RID'].dtype == np.float64
+    assert np.isnan(df['RID'].values[1])
+    assert df['SCRNO'].dtype == np.int64
+    assert df['VISCODE'].tolist() == ['bl', 'm06', 'm12']
+
+
+def test_array_fingerprint_memmap(tmp_path):
+    filename = str(tmp_path / 'block.mmap')
+    block = np.memmap(filename, dtype=np.float32, mode='w+', shape=(4, 3))
+    block[:] = 1
+    block.flush()
+    block = np.memmap(filename, dtype=np.float32, mode='r', shape=(4, 3))
+    key = _array_fingerprint(block)
+    assert key[0] == filename and key[-2:] == ((4, 3), '<f4')
+    # views of the mapping and arrays are keyed on their content
+    assert _array_fingerprint(block[:2]) == _array_fingerprint(np.ones((2, 3),
+                                                               np.float32))
+
+
+def test_stratified_splits_encoded_dataset():
+    from dataset_loader.dataset import _encode_dataset
+    rng = np.random.RandomState(1)
+    subjects = np.repeat(['S%03d' % i for i in rng.permutation(40)], 2)
+    dx_group = np.repeat(rng.choice(['AD', 'MCI', 'Normal'], 40), 2)
+    raw = Bunch(subjects=subjects, dx_group=dx_group)
+    encoded = _encode_dataset(Bunch(subjects=subjects.copy(),
+                                    dx_group=dx_group.copy()))
+    # integer codes must not change the splits of the string labels
+    for groups in [['AD', 'Normal'], ['AD', 'MCI', 'Normal']]:
+        splits = StratifiedSubjectShuffleSplit(raw, groups, n_iter=5)
+        splits_encoded = StratifiedSubjectShuffleSplit(encoded, groups,
+                                                       n_iter=5)
+        for (train, test), (train_enc, test_enc) in zip(splits,
+                                                        splits_encoded):
+            np.testing.assert_array_equal(train, train_enc)
+            np.testing.assert_array_equal(test, test_enc)
+
+
+def test_group_index_in_place_edit():
+    dx_group = np.array(['AD', 'Normal', 'AD', 'MCI'], dtype=object)
+    assert _get_group_indices(dx_group)['AD'].tolist() == [0, 2]
+    dx_group[0] = 'Normal'
+    assert _get_group_indices(dx_group)['AD'].tolist() == [2]
+    assert _get_group_masks(dx_group)['Normal'].tolist() == [True, True,
+                                                             False, False]
+    dx_group = dx_group.astype(str)
+    dx_group[2] = 'MCI'
+    assert _get_group_indices(dx_group)['AD'].tolist() == []
+    task = _get_task(dx_group, ['MCI', 'Normal'])
+    assert task.labels.tolist() == [-1, -1, 1, 1]
@@ -1,30 +1,754 @@
 import os
 import glob
+import time
+import tempfile
+import threading
+import importlib
 import numpy as np
-import pandas as pd
-import nibabel as nib
-from datetime import date
-from sklearn.model_selection import StratifiedShuffleSplit, ShuffleSplit
-from sklearn.metrics import accuracy_score
+from collections import OrderedDict
+from contextlib import contextmanager
+try:
+    from collections.abc import KeysView, ValuesView, ItemsView
+except ImportError:
+    from collections import KeysView, ValuesView, ItemsView
+
+
+class _LazyModule(object):
+    """ Module proxy, the module is imported on first attribute access
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+# pandas is only needed once a clinical table is read
+pd = _LazyModule('pandas')
+
+
+class Bunch(dict):
+    """ Container exposing its keys as attributes,
+    same as sklearn.utils.Bunch without importing scikit-learn
+    """
+    def __init__(self, **kwargs):
+        super(Bunch, self).__init__(kwargs)
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+    def __dir__(self):
+        return list(self.keys())
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+
+def _get_n_rows(dataset):
+    """ Returns the number of rows of a dataset (length of its subjects,
+    or of its first array field)
+    """
+    if 'subjects' in dataset.keys():
+        return len(dataset['subjects'])
+    for k in dataset.keys():
+        v = dataset[k]
+        if hasattr(v, '__len__') and not isinstance(v, (str, dict)):
+            return len(v)
+    return 0
+
+
+class DatasetView(dict):
+    """ Rows idx of a parent dataset. Row fields are gathered on first
+    access and cached (contiguous rows are sliced without copy), other
+    fields are passed through. Views of views index the root dataset.
+    Assigned fields are kept in the view, the parent is never modified.
+    Deleted fields are hidden in the view.
+    The view is a dict (its fields are not stored in the dict itself but
+    read through the mapping methods), it is pickled as a Bunch of its
+    rows
+    """
+    def __init__(self, parent, idx):
+        idx = np.asarray(idx, dtype=np.intp)
+        if (isinstance(parent, DatasetView) and not parent._fields_set and
+                not parent._fields_del):
+            idx = parent._idx[idx]
+            n_rows = parent._n_rows
+            parent = parent._parent
+        else:
+            n_rows = _get_n_rows(parent)
+        rows = idx
+        if len(idx) > 0 and np.array_equal(
+                idx, np.arange(idx[0], idx[0] + len(idx))):
+            rows = slice(int(idx[0]), int(idx[0]) + len(idx))
+        self.__dict__.update(_parent=parent, _idx=idx, _rows=rows,
+                             _n_rows=n_rows, _fields={}, _fields_set=set(),
+                             _fields_del=set())
+
+    def __getitem__(self, key):
+        if key in self._fields_del:
+            raise KeyError(key)
+        if key not in self._fields:
+            values = self._parent[key]
+            if (hasattr(values, '__len__') and
+                    not isinstance(values, (str, dict)) and
+                    len(values) == self._n_rows):
+                if isinstance(self._rows, slice):
+                    values = values[self._rows]
+                else:
+                    values = _take(values, self._idx)
+            self._fields[key] = values
+        return self._fields[key]
+
+    def __setitem__(self, key, value):
+        self._fields[key] = value
+        self._fields_set.add(key)
+        self._fields_del.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._fields.pop(key, None)
+        self._fields_set.discard(key)
+        if key in self._parent.keys():
+            self._fields_del.add(key)
+
+    def __iter__(self):
+        for k in self._parent.keys():
+            if k not in self._fields_del:
+                yield k
+        for k in self._fields_set:
+            if k not in self._parent.keys():
+                yield k
+
+    def __reversed__(self):
+        return reversed(list(self))
+
+    def __len__(self):
+        return len((set(self._parent.keys()) - self._fields_del) |
+                   self._fields_set)
+
+    def __contains__(self, key):
+        return key in self._fields_set or (
+            key in self._parent.keys() and key not in self._fields_del)
+
+    def __eq__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'DatasetView(%d rows, %s)' % (len(self._idx), list(self))
+
+    def keys(self):
+        return KeysView(self)
+
+    def values(self):
+        return ValuesView(self)
+
+    def items(self):
+        return ItemsView(self)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        value = self[key]
+        del self[key]
+        return value
+
+    def popitem(self):
+        keys = list(self)
+        if not keys:
+            raise KeyError('popitem(): dictionary is empty')
+        return keys[-1], self.pop(keys[-1])
+
+    def clear(self):
+        for k in list(self):
+            del self[k]
+
+    def copy(self):
+        return self.__copy__()
+
+    def __or__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        merged = self.materialize()
+        merged.update(other)
+        return merged
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def __getattr__(self, key):
+        # private attributes are missing while the view is being built
+        if key.startswith('_'):
+            raise AttributeError(key)
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        self[key] = value
+
+    def __delattr__(self, key):
+        try:
+            del self[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __dir__(self):
+        return list(self.keys())
+
+    def __reduce_ex__(self, protocol):
+        return Bunch, (), None, None, iter(self.materialize().items())
+
+    def __copy__(self):
+        view = DatasetView.__new__(DatasetView)
+        view.__dict__.update(self.__dict__, _fields=dict(self._fields),
+                             _fields_set=set(self._fields_set),
+                             _fields_del=set(self._fields_del))
+        return view
+
+    def materialize(self):
+        """ Returns the view as a Bunch
+        """
+        return Bunch(**dict((k, self[k]) for k in self.keys()))
+
+
+# dtypes of the non-numerical and id columns of the clinical tables,
+# every other column read through _read_csv is parsed as float64
+# (int64 ids are float64 in the tables where some are missing)
+CSV_DTYPES = {'RID': np.int64,
+              'SCRNO': np.int64,
+              'PTID': str,
+              'VISCODE': str,
+              'VISCODE2': str,
+              'EXAMDATE': str}
+
+# date columns of the clinical tables, converted to datetime64[D]
+CSV_DATES = ['EXAMDATE']
+
+# parsed clinical table columns, shared by the loaders
+_CSV_CACHE = {}
+_CSV_FILE_LOCKS = {}
+_CSV_CACHE_LOCK = threading.Lock()
+
+# storage dtypes of the image blocks per quantize mode
+QUANTIZE_DTYPES = {None: np.float32,
+                   'float16': np.float16,
+                   'uint16': np.uint16}
+
+# uint16 code of the missing (NaN) voxels
+UINT16_NAN = 65535
+
+# files read by the loaders of the current thread, see _record_sources
+_SOURCES = threading.local()
+
+# loaded and combined masks, keyed on their files versions
+_MASK_CACHE = {}
+_MASK_CACHE_LOCK = threading.Lock()
+
+# group indices of the last used dx_group columns, keyed on column identity
+# and checked against their content
+_GROUP_INDEX_CACHE = OrderedDict()
+_GROUP_INDEX_CACHE_SIZE = 16
+_GROUP_INDEX_LOCK = threading.Lock()
 
 
 def array_to_niis(data, mask):
     """ Converts masked nii 4D array to 4D niimg
     """
-    mask_img = nib.load(mask)
-    data_ = np.zeros(data.shape[:1] + mask_img.shape)
-    data_[:, mask_img.get_data().astype(np.bool)] = data
+    import nibabel as nib
+    mask = _get_mask(mask)
+    data_ = np.zeros((len(data), int(np.prod(mask.shape))))
+    data_[:, mask.indices] = data
+    data_ = data_.reshape((len(data),) + mask.shape)
     data_ = np.transpose(data_, axes=(1, 2, 3, 0))
-    return nib.Nifti1Image(data_, mask_img.get_affine())
+    return nib.Nifti1Image(data_, mask.affine)
 
 
 def array_to_nii(data, mask):
     """ Converts masked nii 3D array to 3D niimg
     """
-    mask_img = nib.load(mask)
-    data_ = np.zeros(mask_img.shape)
-    data_[mask_img.get_data().astype(np.bool)] = data
-    return nib.Nifti1Image(data_, mask_img.get_affine())
+    import nibabel as nib
+    mask = _get_mask(mask)
+    data_ = np.zeros(int(np.prod(mask.shape)))
+    data_[mask.indices] = data
+    return nib.Nifti1Image(data_.reshape(mask.shape), mask.affine)
+
+
+def _get_mask_bbox(mask):
+    """ Returns the slices of the bounding box of a boolean mask
+    """
+    bbox = []
+    for axis in range(mask.ndim):
+        other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+        idx = np.flatnonzero(mask.any(axis=other_axes))
+        bbox.append(slice(int(idx[0]), int(idx[-1]) + 1) if len(idx)
+                    else slice(0, 0))
+    return tuple(bbox)
+
+
+def _make_mask(mask, affine, key):
+    """ Returns the read-only mask Bunch of a boolean mask array :
+    mask, flat int32 voxel indices, shape, affine and bounding box
+    """
+    mask = np.asarray(mask, dtype=bool)
+    indices = np.flatnonzero(mask).astype(np.int32)
+    for a in (mask, indices, affine):
+        a.setflags(write=False)
+    return Bunch(mask=mask, indices=indices, shape=mask.shape,
+                 affine=affine, bbox=_get_mask_bbox(mask), key=key)
+
+
+def _get_mask(mask):
+    """ Returns the mask Bunch of a mask file, loaded once per file
+    version (mask Bunches and None are returned as they are)
+    """
+    if mask is None or isinstance(mask, dict):
+        return mask
+    import nibabel as nib
+    stat = os.stat(mask)
+    key = (os.path.abspath(mask), stat.st_mtime, stat.st_size)
+    with _MASK_CACHE_LOCK:
+        entry = _MASK_CACHE.get(key)
+    if entry is None:
+        img = nib.load(mask)
+        entry = _make_mask(np.asarray(img.dataobj), np.array(img.affine),
+                           key)
+        with _MASK_CACHE_LOCK:
+            entry = _MASK_CACHE.setdefault(key, entry)
+    return entry
+
+
+def _combine_masks(masks, how='intersection'):
+    """ Returns the mask Bunch of the intersection or union of masks
+    (files or mask Bunches), cached on the masks
+    """
+    if how not in ['intersection', 'union']:
+        raise ValueError('Unknown mask combination %s' % how)
+    masks = [_get_mask(m) for m in masks]
+    if len(masks) == 1:
+        return masks[0]
+    for m in masks[1:]:
+        if (m.shape != masks[0].shape or
+                not np.allclose(m.affine, masks[0].affine)):
+            raise ValueError('Masks of different shapes or affines')
+    key = (how,) + tuple(m.key for m in masks)
+    with _MASK_CACHE_LOCK:
+        entry = _MASK_CACHE.get(key)
+    if entry is None:
+        combine = np.logical_and if how == 'intersection' else np.logical_or
+        mask = masks[0].mask
+        for m in masks[1:]:
+            mask = combine(mask, m.mask)
+        entry = _make_mask(mask, masks[0].affine, key)
+        with _MASK_CACHE_LOCK:
+            entry = _MASK_CACHE.setdefault(key, entry)
+    return entry
+
+
+def _new_io_stats():
+    """ Returns empty image reading statistics
+    """
+    return dict(n_imgs=0, bytes_read=0, bytes_full=0, time=0.)
+
+
+def _merge_io_stats(io_stats):
+    """ Sums a list of image reading statistics
+    """
+    merged = _new_io_stats()
+    for io in io_stats:
+        for k in merged:
+            merged[k] += io[k]
+    return merged
+
+
+def _io_report(io):
+    """ Returns a one-line summary of image reading statistics
+    """
+    full = max(io['bytes_full'], 1)
+    return ('%d images : read %.1f MB of %.1f MB (%.0f%%) in %.2fs' %
+            (io['n_imgs'], io['bytes_read'] / 1e6, io['bytes_full'] / 1e6,
+             100. * io['bytes_read'] / full, io['time']))
+
+
+def _load_masked_img(img_file, mask=None, io_stats=None):
+    """ Returns the voxels of an image within a mask Bunch
+    (all the voxels if mask is None).
+    For uncompressed .nii files only the bounding box of the mask is
+    read from disk, io_stats accumulates the voxel bytes read
+    """
+    import nibabel as nib
+    start = time.time()
+    img = nib.load(img_file)
+    itemsize = img.get_data_dtype().itemsize
+    bytes_full = int(np.prod(img.shape)) * itemsize
+    if mask is None:
+        data = np.asarray(img.dataobj).ravel()
+        bytes_read = bytes_full
+    elif img_file.endswith('.nii'):
+        # sliced array proxies read the sub-volume only
+        data = np.asarray(img.dataobj[mask.bbox])
+        bytes_read = data.size * itemsize
+        data = data[mask.mask[mask.bbox]]
+    else:
+        data = np.asarray(img.dataobj)[mask.mask]
+        bytes_read = bytes_full
+    if io_stats is not None:
+        io_stats['n_imgs'] += 1
+        io_stats['bytes_read'] += bytes_read
+        io_stats['bytes_full'] += bytes_full
+        io_stats['time'] += time.time() - start
+    return data
+
+
+def _quantize(data, quantize=None):
+    """ Returns data stored with the quantize mode
+    (None : float32, 'float16', 'uint16'), its scale and min.
+    uint16 values are coded from 0 to 65534, NaN is coded UINT16_NAN
+    """
+    if quantize is None:
+        return data.astype(np.float32), 1., 0.
+    if quantize == 'float16':
+        return data.astype(np.float16), 1., 0.
+    nans = np.isnan(data)
+    if nans.all():
+        return np.full(data.shape, UINT16_NAN, dtype=np.uint16), 1., 0.
+    data_min, data_max = np.nanmin(data), np.nanmax(data)
+    scale = ((data_max - data_min) / (UINT16_NAN - 1.)
+             if data_max > data_min else 1.)
+    values = np.round((np.where(nans, data_min, data) - data_min) / scale)
+    values = values.astype(np.uint16)
+    values[nans] = UINT16_NAN
+    return values, scale, data_min
+
+
+def _dequantize(data, scale=1., data_min=0.):
+    """ Returns float32 values of quantized rows,
+    scale and data_min are scalars or per-row arrays
+    """
+    nans = data == UINT16_NAN if data.dtype == np.uint16 else None
+    data = data.astype(np.float32)
+    if np.any(scale != 1.) or np.any(data_min != 0.):
+        shape = (-1,) + (1,) * (data.ndim - 1)
+        data *= np.reshape(scale, shape)
+        data += np.reshape(data_min, shape)
+    if nans is not None:
+        data[nans] = np.nan
+    return data
+
+
+def _load_img_rows(img_files, rows, filename, shape, mask=None,
+                   quantize=None):
+    """ Loads images (masked if a mask file or Bunch is given) into the rows
+    of the memmapped block filename.
+    Returns the scale, min and reconstruction errors (max, rms) of the rows
+    and the reading statistics
+    """
+    block = np.memmap(filename, dtype=QUANTIZE_DTYPES[quantize], mode='r+',
+                      shape=shape)
+    mask = _get_mask(mask)
+    io_stats = _new_io_stats()
+    stats = np.zeros((len(rows), 4))
+    for i, (img_file, row) in enumerate(zip(img_files, rows)):
+        data = _load_masked_img(img_file, mask, io_stats)
+        values, scale, data_min = _quantize(data, quantize)
+        block[row] = values
+        error = np.abs(_dequantize(values, scale, data_min) - data)
+        stats[i] = (scale, data_min, np.nanmax(error, initial=0),
+                    np.sqrt(np.nanmean(error ** 2)) if error.size else 0)
+    block.flush()
+    return stats, io_stats
+
+
+def _load_imgs_block(img_files, mask=None, n_jobs=1, filename=None,
+                     quantize=None):
+    """ Returns a read-only memmap (n_images x n_features) of the images,
+    loaded in place by a process pool, the per-image scale, min,
+    max and rms reconstruction errors of the quantize mode and the
+    reading statistics.
+    Without filename the block is a temporary file, removed once mapped
+    """
+    import nibabel as nib
+    if quantize not in QUANTIZE_DTYPES:
+        raise ValueError('Unknown quantize mode %s' % quantize)
+    dtype = QUANTIZE_DTYPES[quantize]
+    img_files = np.asarray(img_files)
+    if mask is not None:
+        # workers get the mask file and load it once each
+        n_features = len(_get_mask(mask).indices)
+    else:
+        n_features = int(np.prod(nib.load(img_files[0]).shape))
+    shape = (len(img_files), n_features)
+    if len(img_files) == 0:
+        return (np.empty(shape, dtype=dtype), np.zeros((0, 4)),
+                _new_io_stats())
+    temporary = filename is None
+    if temporary:
+        fd, filename = tempfile.mkstemp(prefix='dataset_loader_',
+                                        suffix='.mmap')
+        os.close(fd)
+    # allocate the block, the workers write their own rows
+    np.memmap(filename, dtype=dtype, mode='w+', shape=shape).flush()
+    chunks = np.array_split(np.arange(len(img_files)),
+                            min(len(img_files), 4 * abs(n_jobs)))
+    if n_jobs == 1:
+        results = [_load_img_rows(img_files[rows], rows, filename, shape,
+                                  mask, quantize) for rows in chunks]
+    else:
+        from joblib import Parallel, delayed
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(_load_img_rows)(img_files[rows], rows, filename, shape,
+                                    mask, quantize) for rows in chunks)
+    block = np.memmap(filename, dtype=dtype, mode='r', shape=shape)
+    if temporary:
+        try:
+            # the mapping outlives the file
+            os.remove(filename)
+        except OSError:
+            pass
+    stats, io_stats = zip(*results)
+    return block, np.vstack(stats), _merge_io_stats(io_stats)
+
+
+def _iter_dequantized(block, scale, data_min, rows=None, chunk_size=256):
+    """ Yields (rows, float32 values) of the block by chunks of rows
+    """
+    if rows is None:
+        rows = np.arange(len(block))
+    rows = np.asarray(rows)
+    scale = np.broadcast_to(scale, (len(block),))
+    data_min = np.broadcast_to(data_min, (len(block),))
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        yield chunk, _dequantize(block[chunk], scale[chunk], data_min[chunk])
+
+
+def _accumulate_moments(img_files, labels, mask=None):
+    """ Returns the (count, mean, M2) of the masked images of each label,
+    with one image in memory at a time (Welford update),
+    and the reading statistics
+    """
+    mask = _get_mask(mask)
+    io_stats = _new_io_stats()
+    moments = {}
+    for img_file, label in zip(img_files, labels):
+        if pd.isna(label):
+            # images without dx (unmatched subjects) are in no group
+            continue
+        x = _load_masked_img(img_file, mask, io_stats).astype(np.float64)
+        n, mean, m2 = moments.get(label, (0, 0., 0.))
+        n += 1
+        delta = x - mean
+        mean = mean + delta / n
+        m2 = m2 + delta * (x - mean)
+        moments[label] = (n, mean, m2)
+    return moments, io_stats
+
+
+def _merge_moments(a, b):
+    """ Returns the (count, mean, M2) of the union of two samples
+    (Chan et al. pairwise update)
+    """
+    n_a, mean_a, m2_a = a
+    n_b, mean_b, m2_b = b
+    if n_a == 0:
+        return b
+    if n_b == 0:
+        return a
+    n = n_a + n_b
+    delta = mean_b - mean_a
+    return (n, mean_a + delta * (n_b / float(n)),
+            m2_a + m2_b + delta ** 2 * (n_a * n_b / float(n)))
+
+
+def _merge_label_moments(label_moments):
+    """ Merges a list of {label: (count, mean, M2)} partial results
+    """
+    moments = {}
+    for partial in label_moments:
+        for label, m in partial.items():
+            moments[label] = _merge_moments(moments.get(label, (0, 0., 0.)),
+                                            m)
+    return moments
+
+
+def _get_group_moments(moments, groups=None):
+    """ Returns the (count, mean, M2) of the clinical groups
+    of _get_group_indices from the moments of each dx label
+    (missing labels are in no group)
+    """
+    labels = np.array(sorted(k for k in moments.keys() if not pd.isna(k)),
+                      dtype=object)
+    group_labels = _compute_group_indices(labels)
+    if groups is None:
+        groups = sorted(group_labels.keys())
+    group_moments = {}
+    for g in groups:
+        m = (0, 0., 0.)
+        for label in labels[group_labels[g]]:
+            m = _merge_moments(m, moments[label])
+        group_moments[g] = m
+    return group_moments
+
+
+def _temp_memmap(shape, dtype=np.float32):
+    """ Returns a writable memmap of a temporary file, removed at once
+    (the mapping outlives the file)
+    """
+    fd, filename = tempfile.mkstemp(prefix='dataset_loader_', suffix='.mmap')
+    os.close(fd)
+    if int(np.prod(shape)) == 0:
+        os.remove(filename)
+        return np.empty(shape, dtype=dtype)
+    block = np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+    return block
+
+
+def _viscode_to_month(vcodes):
+    """ Returns the months of ADNI visit codes
+    ('bl', 'sc', ... : 0, 'm06' : 6, ...), nan for unknown codes
+    """
+    vcodes = np.asarray(vcodes).astype(str)
+    months = np.full(len(vcodes), np.nan)
+    months[np.isin(vcodes, ['bl', 'sc', 'scmri', 'init'])] = 0
+    visits = np.flatnonzero(np.char.startswith(vcodes, 'm'))
+    digits = np.char.lstrip(vcodes[visits], 'm')
+    is_month = np.char.isdigit(digits)
+    months[visits[is_month]] = digits[is_month].astype(int)
+    return months
+
+
+def _build_trajectories(subjects, vcodes, values):
+    """ Returns the subjects, the observed visit months and the
+    subject x month (x feature) matrix of the mean values of each visit,
+    with its mask of observed values, built by one scatter of the rows
+    """
+    months = _viscode_to_month(vcodes)
+    values = np.asarray(values, dtype=np.float64)
+    codes, categories = _get_codes(subjects)
+    keep = ~np.isnan(months) & (codes >= 0)
+    rows = codes[keep]
+    cols_months, cols = np.unique(months[keep], return_inverse=True)
+    values = values[keep]
+    observed = ~np.isnan(values)
+
+    shape = (len(categories), len(cols_months)) + values.shape[1:]
+    sums = np.zeros(shape)
+    counts = np.zeros(shape, dtype=np.int32)
+    np.add.at(sums, (rows, cols), np.where(observed, values, 0.))
+    np.add.at(counts, (rows, cols), observed)
+    mask = counts > 0
+    data = np.full(shape, np.nan)
+    data[mask] = sums[mask] / counts[mask]
+    return np.asarray(categories), cols_months.astype(int), data, mask
+
+
+def _get_change_times(baseline_rows, followup_rows, offsets, vcodes,
+                      exam_dates=None):
+    """ Returns the years between each follow-up row and the baseline row
+    of its subject, from the exam dates if any, else from the visit codes
+    (VISCODE2 : ADNIGO/2 VISCODE as v03 are not months)
+    """
+    n_followups = np.diff(offsets)
+    months = _viscode_to_month(vcodes)
+    times = (months[followup_rows] -
+             np.repeat(months[baseline_rows], n_followups)) / 12.
+    if exam_dates is not None:
+        dates = np.asarray(exam_dates, dtype='datetime64[D]')
+        days = ((dates[followup_rows] -
+                 np.repeat(dates[baseline_rows], n_followups)) /
+                np.timedelta64(1, 'D'))
+        times = np.where(np.isnan(days), times, days / 365.25)
+    return times
+
+
+def _segment_sums(values, offsets):
+    """ Returns the sums of values[offsets[i]:offsets[i + 1]]
+    (zero for empty segments)
+    """
+    sums = np.cumsum(values, axis=0, dtype=np.float64)
+    sums = np.concatenate((np.zeros((1,) + values.shape[1:]), sums))
+    return sums[offsets[1:]] - sums[offsets[:-1]]
+
+
+def _change_features(baseline, followups, times, offsets):
+    """ Returns the follow-up minus baseline values and the per-subject
+    least squares slopes (per year, nan without follow-up spread) of
+    ragged follow-ups : followups[offsets[i]:offsets[i + 1]] of subject i,
+    taken times years after its baseline
+    """
+    baseline = np.asarray(baseline, dtype=np.float64)
+    followups = np.asarray(followups, dtype=np.float64)
+    n_followups = np.diff(offsets)
+    delta = followups - np.repeat(baseline, n_followups, axis=0)
+    # slopes of the delta (baseline at time 0) over all visits
+    times_ = times.reshape((-1,) + (1,) * (delta.ndim - 1))
+    n = (1 + n_followups).reshape((-1,) + (1,) * (delta.ndim - 1))
+    sum_t = _segment_sums(times_, offsets)
+    sum_tt = _segment_sums(times_ ** 2, offsets)
+    sum_d = _segment_sums(delta, offsets)
+    sum_td = _segment_sums(times_ * delta, offsets)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (n * sum_td - sum_t * sum_d) / (n * sum_tt - sum_t ** 2)
+    return delta, slope
+
+
+def _block_change_features(block, scale, data_min, offsets, times,
+                           chunk_size=64):
+    """ Returns float32 memmaps of the change features of an image block
+    (baseline rows then follow-up rows, offsets of the follow-ups),
+    computed by chunks of subjects
+    """
+    n_subjects = len(offsets) - 1
+    delta = _temp_memmap((offsets[-1], block.shape[1]))
+    slope = _temp_memmap((n_subjects, block.shape[1]))
+    for start in range(0, n_subjects, chunk_size):
+        stop = min(start + chunk_size, n_subjects)
+        first, last = offsets[start], offsets[stop]
+        # baseline and follow-up rows of a chunk are contiguous
+        rows = slice(n_subjects + first, n_subjects + last)
+        baseline = _dequantize(block[start:stop], scale[start:stop],
+                               data_min[start:stop])
+        followups = _dequantize(block[rows], scale[rows], data_min[rows])
+        delta[first:last], slope[start:stop] = _change_features(
+            baseline, followups, times[first:last],
+            offsets[start:stop + 1] - first)
+    return delta, slope
 
 
 def _get_subjects_and_description(base_dir,
@@ -36,11 +760,14 @@ def _get_subjects_and_description(base_dir,
 
     # load files and get dirs
     BASE_DIR = _get_data_base_dir(base_dir)
+    # the directory changes when subjects are added or removed
+    _add_source(BASE_DIR)
     subject_paths = sorted(glob.glob(os.path.join(BASE_DIR, prefix)))
 
     fname = os.path.join(BASE_DIR, exclusion_file)
     if not os.path.isfile(fname):
         raise OSError('%s not found ...' % fname)
+    _add_source(fname)
     excluded_subjects = []
     if os.stat(fname).st_size > 0:
         excluded_subjects = np.loadtxt(fname, dtype=bytes).astype(str)
@@ -48,6 +775,7 @@ def _get_subjects_and_description(base_dir,
     fname = os.path.join(BASE_DIR, description_csv)
     if not os.path.isfile(fname):
         raise OSError('%s not found ...' % fname)
+    _add_source(fname)
     description = pd.read_csv(fname)
 
     # exclude bad QC subjects
@@ -64,6 +792,27 @@ def _get_subjects_and_description(base_dir,
     return subjects, subject_paths, description
 
 
+def _filter_description(description, subjects=None, dx_groups=None,
+                        date_range=None, date_column='Exam_Date',
+                        date_format='%Y-%m-%d'):
+    """ Returns the boolean mask of the description rows of the given
+    subjects, dx groups and dates range (start, end), None for no filter
+    """
+    keep = np.ones(len(description), dtype=bool)
+    if subjects is not None:
+        keep &= description['Subject_ID'].isin(subjects).values
+    if dx_groups is not None:
+        keep &= description['DX_Group'].isin(dx_groups).values
+    if date_range is not None:
+        dates = _to_datetime64(description[date_column].values, date_format)
+        start, end = date_range
+        if start is not None:
+            keep &= dates >= np.datetime64(start, 'D')
+        if end is not None:
+            keep &= dates <= np.datetime64(end, 'D')
+    return keep
+
+
 def _glob_subject_img(subject_path, suffix, first_img=False):
     """ Get subject image (pet, func, ...)
         for a given subject and a suffix
@@ -83,7 +832,7 @@ def _get_base_dir(verbose=0):
     """
     base_dir = ''
     with open(os.path.join(os.path.dirname(__file__), 'paths.pref'),
-              'rU') as f:
+              'r') as f:
         paths = [x.strip() for x in f.read().split('\n')]
         for path in paths:
             if os.path.isdir(path):
@@ -108,6 +857,96 @@ def _get_cache_base_dir():
     return _get_data_base_dir('tmp')
 
 
+@contextmanager
+def _record_sources():
+    """ Context manager yielding the list of the files and directories
+    read by the loaders of this thread within the block
+    """
+    sources = []
+    stack = _SOURCES.__dict__.setdefault('stack', [])
+    stack.append(sources)
+    try:
+        yield sources
+    finally:
+        stack.remove(sources)
+
+
+def _add_source(path):
+    """ Records a file or directory read by a loader
+    """
+    path = os.path.abspath(path)
+    for sources in getattr(_SOURCES, 'stack', []):
+        if path not in sources:
+            sources.append(path)
+
+
+def _read_csv(fname, columns=None):
+    """ Reads a clinical csv table.
+    Only the given columns are parsed, with their dtypes from CSV_DTYPES.
+    Parsed columns are kept in memory and shared by the loaders and their
+    threads, until the file changes (returned tables must not be modified
+    in place)
+    """
+    _add_source(fname)
+    if columns is None:
+        return pd.read_csv(fname)
+    stat = os.stat(fname)
+    key = os.path.abspath(fname)
+    version = (stat.st_mtime, stat.st_size)
+    with _CSV_CACHE_LOCK:
+        lock = _CSV_FILE_LOCKS.setdefault(key, threading.Lock())
+    with lock:
+        cached_version, table = _CSV_CACHE.get(key, (None, None))
+        if cached_version != version:
+            table = None
+        missing = columns if table is None else [c for c in columns
+                                                 if c not in table.columns]
+        if missing:
+            parsed = _parse_csv(fname, missing)
+            if table is not None:
+                parsed = pd.concat([table, parsed], axis=1)
+            table = parsed
+            _CSV_CACHE[key] = (version, table)
+    return table[columns]
+
+
+def _parse_csv(fname, columns):
+    """ Parses the given columns of a csv table with their dtypes
+    """
+    dtype = dict((c, CSV_DTYPES.get(c, np.float64)) for c in columns)
+    # integer ids are parsed as float, they stay float if some are missing
+    int_columns = [c for c in columns if dtype[c] is np.int64]
+    dtype.update((c, np.float64) for c in int_columns)
+    df = pd.read_csv(fname, usecols=columns, dtype=dtype)
+    for c in int_columns:
+        if df[c].notnull().all():
+            df[c] = df[c].astype(np.int64)
+    for c in CSV_DATES:
+        if c in columns:
+            df[c] = _to_datetime64(df[c].values)
+    return df
+
+
+def _to_datetime64(dates, date_format='%Y-%m-%d'):
+    """ Parses date strings into a datetime64[D] array
+    (unparsable dates are NaT)
+    """
+    dates = np.asarray(dates)
+    if np.issubdtype(dates.dtype, np.datetime64):
+        return dates.astype('datetime64[D]')
+    dates = pd.to_datetime(pd.Series(dates), format=date_format,
+                           errors='coerce')
+    return dates.values.astype('datetime64[D]')
+
+
+def _get_ages(exam_dates, dobs):
+    """ Returns ages in years (rounded to 2 decimals)
+    at the exam_dates, for the dobs dates of birth
+    """
+    days = np.abs(_to_datetime64(exam_dates) - _to_datetime64(dobs))
+    return np.round(days / np.timedelta64(1, 'D') / 365., decimals=2)
+
+
 def _rid_to_ptid(rid, roster):
     """Returns patient id for a given rid
     """
@@ -135,8 +974,8 @@ def _find_closest_exam_date(acq_date, exam_dates):
     """Returns closest date and indice of the
     closest exam_date from acq_date"""
 
-    diff = [abs(acq_date - e) for e in exam_dates]
-    ind = np.argmin(diff)
+    diff = np.abs(exam_dates - acq_date) / np.timedelta64(1, 'D')
+    ind = np.nanargmin(diff)
     return exam_dates[ind], ind
 
 
@@ -162,20 +1001,36 @@ def _find_closest_exam_code(viscode, exam_codes):
     return viscode, ind
 
 
-def _get_vcodes(rid, exam_date, dx):
-    """ Returns visit codes of an exam_date of a subject
+def _ptids_to_rids(ptids, roster, ptid_label='PTID'):
+    """Returns roster ids of patient ids (-1 when unknown)
+    ptid_label values : 'PTID', 'SCRNO'
     """
+    rids = roster.drop_duplicates(ptid_label).set_index(ptid_label)['RID']
+    rids = rids.reindex(np.asarray(ptids, dtype=object))
+    return rids.fillna(-1).values.astype(np.int64)
 
-    vcodes = dx[(dx.RID == rid) & (dx.EXAMDATE == exam_date)]['VISCODE'].values
-    vcodes2 =\
-        dx[(dx.RID == rid) & (dx.EXAMDATE == exam_date)]['VISCODE2'].values
-
-    if not vcodes.any():
-        vcodes = [np.nan]
-    if not vcodes2.any():
-        vcodes2 = [np.nan]
 
-    return [vcodes[0], vcodes2[0]]
+def _attach_phenotype(rids, acq_dates, dx, max_gap=None):
+    """Returns the clinical visit of each acquisition, matched on rid
+    and closest exam date within max_gap days (as-of join) :
+    exam_dates, visit codes (VISCODE, VISCODE2) and diagnoses (DXCHANGE
+    codes, indices of DX_LIST). Acquisitions without a visit get NaT,
+    nan visit codes and diagnosis 0.
+    """
+    idx = _asof_join_indices(rids, acq_dates, dx['RID'].values,
+                             dx['EXAMDATE'].values, tolerance=max_gap)
+    missing = idx < 0
+    exam_dates = _take_aligned(_to_datetime64(dx['EXAMDATE'].values), idx)
+    vcodes = np.asarray(_take_aligned(dx['VISCODE'].values, idx),
+                        dtype=object)
+    vcodes2 = np.asarray(_take_aligned(dx['VISCODE2'].values, idx),
+                         dtype=object)
+    vcodes[missing] = np.nan
+    vcodes2[missing] = np.nan
+    # DXCHANGE (ADNI GO/2) or DXCURREN (ADNI 1)
+    dxchange = np.fmax(dx['DXCHANGE'].values, dx['DXCURREN'].values)
+    dxchange = np.nan_to_num(_take_aligned(dxchange, idx)).astype(int)
+    return exam_dates, vcodes, vcodes2, dxchange
 
 
 def _get_dx(rid, dx, exam=None, viscode=None, return_code=False):
@@ -187,8 +1042,8 @@ def _get_dx(rid, dx, exam=None, viscode=None, return_code=False):
         raise ValueError('Both exam and viscode are set !')
 
     if exam is not None:
-        dates = dx[dx.RID == rid]['EXAMDATE'].values
-        exam_dates = [date(int(d[:4]), int(d[5:7]), int(d[8:])) for d in dates]
+        exam = np.datetime64(exam, 'D')
+        exam_dates = _to_datetime64(dx[dx.RID == rid]['EXAMDATE'].values)
     elif viscode is not None:
         if viscode[0] == 'v':  # ADNI1
             exam_codes = dx[dx.RID == rid]['VISCODE'].values
@@ -215,6 +1070,8 @@ def _get_dx(rid, dx, exam=None, viscode=None, return_code=False):
             return exam_code
         else:
             return dxchange[ind]
+    elif exam is not None and return_code:
+        return np.datetime64('NaT', 'D')
     else:
         return -4
 
@@ -329,15 +1186,31 @@ def _get_mmse(rid, mmse):
         return 0.
 
 
-def _get_dob(rid, demog):
-    """Returns date of birth of a given rid
+def _get_dobs(rids, demog):
+    """Returns dates of birth (datetime64[D]) of given rids,
+    1900-01-01 when unknown
     """
-    yy = demog[demog.RID == rid]['PTDOBYY'].dropna().values
-    mm = demog[demog.RID == rid]['PTDOBMM'].dropna().values
-    if len(yy) > 0 and len(mm) > 0:
-        return date(int(yy[0]), int(mm[0]), 1)
-    else:
-        return date(1900, 1, 1)
+    dob = demog.groupby('RID')[['PTDOBYY', 'PTDOBMM']].first()
+    dob.index = dob.index.astype(np.float64)
+    dob = dob.reindex(pd.to_numeric(pd.Series(rids), errors='coerce'))
+    months = (dob['PTDOBYY'].values - 1970) * 12 + dob['PTDOBMM'].values - 1
+    known = ~np.isnan(months)
+    dobs = np.empty(len(months), dtype='datetime64[D]')
+    dobs[:] = np.datetime64('1900-01-01')
+    dobs[known] = months[known].astype(np.int64).astype('datetime64[M]')
+    return dobs
+
+
+def _get_median_scores(table, scores, ids, id_label='SCRNO'):
+    """Returns the median of each score for each id (0 when missing),
+    negative scores being clamped to 0, in one grouped pass on the table
+    """
+    values = table[scores].clip(lower=0)
+    medians = values.groupby(table[id_label].values).median()
+    medians.index = medians.index.astype(np.float64)
+    ids = pd.to_numeric(pd.Series(np.asarray(ids, dtype=object)),
+                        errors='coerce')
+    return medians.reindex(ids.values).fillna(0.)
 
 
 def _get_gender(rid, demog):
@@ -350,22 +1223,258 @@ def _get_gender(rid, demog):
         return -1
 
 
-def _get_group_indices(dx_group):
-    """Returns indices for each clinical group
+def _to_categorical(values, categories=None):
+    """Returns values as an integer-coded pandas Categorical.
+    categories is the codebook, extended with the values it misses
+    """
+    if isinstance(values, pd.Categorical) and categories is None:
+        return values
+    values = np.asarray(values, dtype=object)
+    if categories is None:
+        return pd.Categorical(values)
+    observed = pd.unique(values[pd.notnull(values)])
+    missing = np.setdiff1d(observed.astype(str), categories)
+    return pd.Categorical(values,
+                          categories=np.hstack((categories, missing)))
+
+
+def _get_codes(values):
+    """Returns integer codes and sorted codebook of values
+    (missing values are coded -1)
+    """
+    if isinstance(values, pd.Categorical):
+        return values.codes, values.categories
+    codes, categories = pd.factorize(np.asarray(values, dtype=object),
+                                     sort=True)
+    return codes, categories
+
+
+def _get_sorted_codes(values):
+    """Returns integer codes of values ranked as their sorted categories,
+    so that codes sort as the values do (missing values are coded -1)
+    """
+    codes, categories = _get_codes(values)
+    order = np.argsort(np.asarray(categories), kind='mergesort')
+    ranks = np.empty(len(order), dtype=np.intp)
+    ranks[order] = np.arange(len(order))
+    return np.where(codes >= 0, ranks[np.maximum(codes, 0)], -1)
+
+
+def _take(values, idx):
+    """Returns values[idx], keeping integer-coded columns coded
+    """
+    if isinstance(values, pd.Categorical):
+        return values[idx]
+    return np.asarray(values)[idx]
+
+
+def _take_aligned(values, idx):
+    """Returns values[idx], with missing values where idx is -1
+    """
+    missing = np.asarray(idx) < 0
+    if not missing.any():
+        return _take(values, idx)
+    if isinstance(values, pd.Categorical):
+        return values.take(idx, allow_fill=True)
+    values = np.asarray(values)
+    if values.dtype.kind == 'M':
+        taken = np.empty(len(idx), dtype=values.dtype)
+        taken[:] = np.datetime64('NaT')
+    elif values.dtype.kind == 'f':
+        taken = np.empty((len(idx),) + values.shape[1:], dtype=values.dtype)
+        taken[:] = np.nan
+    else:
+        taken = np.empty((len(idx),) + values.shape[1:], dtype=object)
+        taken[:] = None
+    taken[~missing] = values[idx[~missing]]
+    return taken
+
+
+def _join_indices(left_keys, right_keys, how='inner'):
+    """Returns aligned row indices (left_idx, right_idx) of the hash join
+    of two tables given as lists of key columns.
+    Unmatched rows are indexed -1, and missing keys never match.
+    how values : 'inner', 'left', 'outer', 'anti'
+    """
+    if how not in ['inner', 'left', 'outer', 'anti']:
+        raise ValueError('how should be inner, left, outer or anti '
+                         'you gave %s' % how)
+    keys = ['key%u' % i for i in range(len(left_keys))]
+    left = pd.DataFrame(dict((k, np.asarray(c, dtype=object))
+                             for k, c in zip(keys, left_keys)))
+    right = pd.DataFrame(dict((k, np.asarray(c, dtype=object))
+                              for k, c in zip(keys, right_keys)))
+    left['left_idx'] = np.arange(len(left))
+    right['right_idx'] = np.arange(len(right))
+    left = left[left[keys].notnull().all(axis=1).values]
+    right = right[right[keys].notnull().all(axis=1).values]
+    merged = pd.merge(left, right, on=keys, how='inner', sort=False)
+    left_idx = merged['left_idx'].values.astype(np.intp)
+    right_idx = merged['right_idx'].values.astype(np.intp)
+
+    n_left, n_right = len(left_keys[0]), len(right_keys[0])
+    if how in ['left', 'outer', 'anti']:
+        unmatched = np.setdiff1d(np.arange(n_left), left_idx)
+        if how == 'anti':
+            left_idx, right_idx = unmatched, -np.ones(len(unmatched),
+                                                      dtype=np.intp)
+        else:
+            left_idx = np.hstack((left_idx, unmatched))
+            right_idx = np.hstack((right_idx,
+                                   -np.ones(len(unmatched), dtype=np.intp)))
+    # rows ordered as the left table
+    order = np.argsort(left_idx, kind='mergesort')
+    left_idx, right_idx = left_idx[order], right_idx[order]
+    if how == 'outer':
+        unmatched = np.setdiff1d(np.arange(n_right), right_idx)
+        left_idx = np.hstack((left_idx,
+                              -np.ones(len(unmatched), dtype=np.intp)))
+        right_idx = np.hstack((right_idx, unmatched))
+    return left_idx, right_idx
+
+
+def _asof_join_indices(left_by, left_on, right_by, right_on,
+                       tolerance=None):
+    """Returns, for each left row, the index of the right row with the same
+    by key and the nearest on date (-1 when there is none within
+    tolerance days). Both tables are sorted once on dates.
+    """
+    left = pd.DataFrame({'by': np.asarray(left_by, dtype=object),
+                         'on': _to_datetime64(left_on),
+                         'left_idx': np.arange(len(left_by))})
+    right = pd.DataFrame({'by': np.asarray(right_by, dtype=object),
+                          'on': _to_datetime64(right_on),
+                          'right_idx': np.arange(len(right_by))})
+    left = left[(left['on'].notnull() & left['by'].notnull()).values]
+    right = right[(right['on'].notnull() & right['by'].notnull()).values]
+    left = left.sort_values('on', kind='mergesort')
+    right = right.sort_values('on', kind='mergesort')
+    if tolerance is not None:
+        tolerance = pd.Timedelta(days=tolerance)
+    merged = pd.merge_asof(left, right, on='on', by='by',
+                           direction='nearest', tolerance=tolerance)
+    right_idx = -np.ones(len(left_by), dtype=np.intp)
+    matched = merged['right_idx'].notnull().values
+    right_idx[merged['left_idx'].values[matched]] = \
+        merged['right_idx'].values[matched].astype(np.intp)
+    return right_idx
+
+
+def _get_label_indices(values, labels):
+    """Returns the indices of each label in values,
+    from one stable sort of the integer codes of values
     """
-    dx_group = np.array(dx_group)
-    idx = {}
-    for g in ['AD', 'MCI', 'LMCI', 'EMCI', 'Normal', 'MCI-Converter',
-              'Normal->MCI']:
-        idx[g] = np.where(dx_group == g)[0]
+    codes, categories = _get_codes(values)
+    order = np.argsort(codes, kind='mergesort')
+    bounds = np.searchsorted(codes[order], np.arange(len(categories) + 1))
+    label_codes = pd.Index(categories).get_indexer(labels)
+    return [order[bounds[c]:bounds[c + 1]] if c >= 0
+            else np.array([], dtype=np.intp) for c in label_codes]
+
+
+def _get_subject_rows(subjects, selected, order=None):
+    """Returns the rows of the selected subject codes, subject by subject.
+    order is the stable argsort of the subjects codes
+    """
+    if order is None:
+        order = np.argsort(subjects, kind='mergesort')
+    sorted_subjects = subjects[order]
+    starts = np.searchsorted(sorted_subjects, selected, side='left')
+    lengths = np.searchsorted(sorted_subjects, selected, side='right') - starts
+    rows = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return order[rows + np.arange(lengths.sum())]
+
+
+def _compute_group_indices(dx_group):
+    """Computes indices for each clinical group
+    """
+    groups = ['AD', 'MCI', 'LMCI', 'EMCI', 'Normal', 'MCI-Converter',
+              'Normal->MCI']
+    idx = dict(zip(groups, _get_label_indices(dx_group, groups)))
     for g in ['EMCI', 'LMCI']:
         idx['MCI'] = np.hstack((idx['MCI'], idx[g]))
     idx['AD-rest'] = np.hstack((idx['MCI'], idx['Normal']))
     idx['MCI-rest'] = np.hstack((idx['AD'], idx['Normal']))
     idx['Normal-rest'] = np.hstack((idx['AD'], idx['MCI']))
+    for g in idx:
+        idx[g].setflags(write=False)
     return idx
 
 
+def _get_group_index(dx_group):
+    """Returns the group index (indices and masks) of a dx_group column.
+    It is computed once per column object : subsetting a dataset creates
+    new columns, hence new indices, and a column modified in place no
+    longer matches the copy of its content kept in its index
+    """
+    key = id(dx_group)
+    # the bytes of an object column are the pointers of its values,
+    # which stay valid as the copy keeps them alive
+    values = np.array(dx_group, copy=True)
+    content = values.tobytes()
+    with _GROUP_INDEX_LOCK:
+        entry = _GROUP_INDEX_CACHE.get(key)
+        if (entry is not None and entry['dx_group'] is dx_group and
+                entry['content'] == content):
+            _GROUP_INDEX_CACHE.move_to_end(key)
+            return entry
+    entry = {'dx_group': dx_group, 'values': values, 'content': content,
+             'indices': _compute_group_indices(values),
+             'masks': {}}
+    with _GROUP_INDEX_LOCK:
+        _GROUP_INDEX_CACHE[key] = entry
+        while len(_GROUP_INDEX_CACHE) > _GROUP_INDEX_CACHE_SIZE:
+            _GROUP_INDEX_CACHE.popitem(last=False)
+    return entry
+
+
+def _get_group_indices(dx_group):
+    """Returns indices for each clinical group
+    """
+    return dict(_get_group_index(dx_group)['indices'])
+
+
+def _get_group_masks(dx_group):
+    """Returns boolean masks for each clinical group
+    """
+    entry = _get_group_index(dx_group)
+    with _GROUP_INDEX_LOCK:
+        masks = entry['masks']
+        if not masks:
+            for g, idx in entry['indices'].items():
+                mask = np.zeros(len(dx_group), dtype=bool)
+                mask[idx] = True
+                mask.setflags(write=False)
+                masks[g] = mask
+        return dict(masks)
+
+
+def _get_task(dx_group, groups):
+    """Returns the rows (idx) of a classification task between groups,
+    their labels (y) and the labels of all the rows (labels, 0 outside
+    the task) : 1 / -1 for two groups, 1 ... n for n groups.
+    The groups must not overlap (a row has one label)
+    """
+    dx_idx = _get_group_indices(dx_group)
+    dx_masks = _get_group_masks(dx_group)
+    if len(groups) == 2:
+        classes = np.array([1, -1])
+    else:
+        classes = np.arange(1, len(groups) + 1)
+    in_task = np.zeros(len(dx_group), dtype=bool)
+    labels = np.zeros(len(dx_group), dtype=classes.dtype)
+    for group, c in zip(groups, classes):
+        if (in_task & dx_masks[group]).any():
+            raise ValueError('Groups %s overlap' % (groups,))
+        in_task |= dx_masks[group]
+        labels[dx_masks[group]] = c
+    idx = np.hstack([dx_idx[group] for group in groups]).astype(np.intp)
+    y = labels[idx]
+    for values in [idx, y, labels]:
+        values.setflags(write=False)
+    return Bunch(groups=list(groups), idx=idx, y=y, labels=labels)
+
+
 def _get_classification_data(features, dx_group, groups, return_idx=False):
     """Set X and y for classification according to the chosen groups
     Returns : X, y, (idx)
@@ -398,14 +1507,16 @@ def StratifiedSubjectShuffleSplit(dataset, groups, n_iter=100, test_size=.3,
                                   random_state=42):
     """ Stratified ShuffleSplit on subjects
     (train and test size may change depending on the number of acquistions)"""
+    from sklearn.model_selection import StratifiedShuffleSplit
 
     idx = _get_group_indices(dataset.dx_group)
     groups_idx = np.hstack([idx[group] for group in groups])
 
-    subjects = np.asarray(dataset.subjects)
+    subjects = _get_sorted_codes(dataset.subjects)
     subjects = subjects[groups_idx]
+    order = np.argsort(subjects, kind='mergesort')
 
-    dx = np.asarray(dataset.dx_group)
+    dx = _get_sorted_codes(dataset.dx_group)
     dx = dx[groups_idx]
 
     # extract unique subject ids and dx
@@ -420,7 +1531,7 @@ def StratifiedSubjectShuffleSplit(dataset, groups, n_iter=100, test_size=.3,
     sss = StratifiedShuffleSplit(n_splits=n_iter, test_size=test_size,
                                  random_state=random_state)
     ssss = []
-    for tr, ts in sss:
+    for tr, ts in sss.split(subjects_unique_values, y):
         # get training subjects
         subjects_tr = subjects_unique_values[tr]
 
@@ -428,12 +1539,8 @@ def StratifiedSubjectShuffleSplit(dataset, groups, n_iter=100, test_size=.3,
         subjects_ts = subjects_unique_values[ts]
 
         # get all subject indices
-        train = []
-        test = []
-        for subj in subjects_tr:
-            train.extend(np.where(subjects == subj)[0])
-        for subj in subjects_ts:
-            test.extend(np.where(subjects == subj)[0])
+        train = _get_subject_rows(subjects, subjects_tr, order)
+        test = _get_subject_rows(subjects, subjects_ts, order)
 
         # append ssss
         ssss.append([train, test])
@@ -444,14 +1551,19 @@ def SubjectShuffleSplit(dataset, groups, n_iter=100,
                         test_size=.3, random_state=42):
     """ Specific ShuffleSplit (train on all subject images,
     but test only on one image of the remaining subjects)"""
+    from sklearn.model_selection import ShuffleSplit
 
     idx = _get_group_indices(dataset.dx_group)
     groups_idx = np.hstack((idx[groups[0]],
                             idx[groups[1]]))
 
-    subjects = np.asarray(dataset.subjects)
+    subjects = _get_sorted_codes(dataset.subjects)
     subjects = subjects[groups_idx]
-    subjects_unique = np.unique(subjects)
+    order = np.argsort(subjects, kind='mergesort')
+    subjects_unique, first_idx = np.unique(subjects[order],
+                                           return_index=True)
+    # first image of each subject
+    first_idx = order[first_idx]
 
     n = len(subjects_unique)
     X = np.empty((n, n))
@@ -460,15 +1572,8 @@ def SubjectShuffleSplit(dataset, groups, n_iter=100,
 
     subj_ss = []
     for train, test in ss.split(X):
-        train_get = np.array([], dtype=int)
-        for subj in subjects_unique[train]:
-            subj_ind = np.where(subjects == subj)
-            train_get = np.concatenate((train_get, subj_ind[0]))
-        test_get = []
-        for subj in subjects_unique[test]:
-            subj_ind = np.where(subjects == subj)
-            test_get.append(subj_ind[0][0])
-        test_get = np.asarray(test_get)
+        train_get = _get_subject_rows(subjects, subjects_unique[train], order)
+        test_get = first_idx[test]
         subj_ss.append([train_get, test_get])
 
     return subj_ss
@@ -477,7 +1582,9 @@ def SubjectShuffleSplit(dataset, groups, n_iter=100,
 def SubjectSplit(dataset, n_iter=100, test_size=.3, random_state=42):
     """ Without dx version (split on subjects)
     """
-    subjects = np.hstack(dataset.subjects)
+    from sklearn.model_selection import ShuffleSplit
+    subjects = _get_sorted_codes(np.hstack(dataset.subjects))
+    order = np.argsort(subjects, kind='mergesort')
     subjects_unique = np.unique(subjects)
 
     n = len(subjects_unique)
@@ -485,19 +1592,78 @@ def SubjectSplit(dataset, n_iter=100, test_size=.3, random_state=42):
                       test_size=test_size, random_state=random_state)
 
     subj_ss = []
-    for train, test in ss:
-        train_get = np.array([], dtype=int)
-        for subj in subjects_unique[train]:
-            subj_ind = np.where(subjects == subj)
-            train_get = np.concatenate((train_get, subj_ind[0]))
-        test_get = np.array([], dtype=int)
-        for subj in subjects_unique[test]:
-            subj_ind = np.where(subjects == subj)
-            test_get = np.concatenate((test_get, subj_ind[0]))
+    for train, test in ss.split(subjects_unique):
+        train_get = _get_subject_rows(subjects, subjects_unique[train], order)
+        test_get = _get_subject_rows(subjects, subjects_unique[test], order)
         subj_ss.append([train_get, test_get])
     return subj_ss
 
 
+def _get_task_splits(dataset, task, n_iter=100, test_size=.3,
+                     random_state=42, stratified=True):
+    """Returns the subject splits of a task as rows of the dataset
+    """
+    if stratified:
+        splits = StratifiedSubjectShuffleSplit(
+            dataset, task.groups, n_iter=n_iter, test_size=test_size,
+            random_state=random_state)
+    else:
+        splits = SubjectShuffleSplit(dataset, task.groups, n_iter=n_iter,
+                                     test_size=test_size,
+                                     random_state=random_state)
+    # splits index the task rows
+    return [[task.idx[train], task.idx[test]] for train, test in splits]
+
+
+def _array_fingerprint(X):
+    """ Returns a cache key of an array : the version of its file for
+    a whole memory-mapped file, the hash of its content otherwise
+    """
+    import mmap
+    import joblib
+    if (isinstance(X, np.memmap) and isinstance(X.base, mmap.mmap) and
+            X.filename is not None and os.path.exists(X.filename)):
+        stat = os.stat(X.filename)
+        return (os.path.abspath(X.filename), stat.st_size, stat.st_mtime,
+                X.offset, X.shape, X.dtype.str)
+    return joblib.hash(np.asarray(X))
+
+
+def _gram_matrix(X, scale=None, data_min=None, chunk_size=256):
+    """ Returns the Gram matrix X.X^T (float64) computed by chunks of rows,
+    only two chunks of X are in memory at a time (X may be a quantized
+    block with the scale and min of its rows)
+    """
+    def get_rows(start):
+        rows = slice(start, min(start + chunk_size, n))
+        values = X[rows]
+        if scale is not None:
+            values = _dequantize(values, scale[rows], data_min[rows])
+        return np.asarray(values, dtype=np.float64).reshape(
+            rows.stop - rows.start, -1)
+
+    n = len(X)
+    K = np.empty((n, n))
+    starts = range(0, n, chunk_size)
+    for i in starts:
+        a = get_rows(i)
+        for j in starts:
+            if j < i:
+                continue
+            b = a if j == i else get_rows(j)
+            K[i:i + len(a), j:j + len(b)] = a.dot(b.T)
+            K[j:j + len(b), i:i + len(a)] = K[i:i + len(a), j:j + len(b)].T
+    return K
+
+
+def _train_and_score_precomputed(clf, K, y, train, test):
+    """ Fit a precomputed-kernel classifier clf on the train set
+    and return the accuracy score on test set"""
+
+    clf.fit(K[np.ix_(train, train)], y[train])
+    return clf.score(K[np.ix_(test, train)], y[test])
+
+
 def _train_and_score(clf, X, y, train, test):
     """ Fit a classifier clf and train set
     and return the accuracy score on test set"""
@@ -510,6 +1676,7 @@ def _train_and_score_2(clf, X, y, train, test):
     """ Fit a classifier clf and train set
     and return the score on test set"""
 
+    from sklearn.metrics import accuracy_score
     clf.fit(X[train], y[train])
     y_pred = clf.predict(X[test])
     return accuracy_score(y[test], y_pred)
@@ -519,6 +1686,7 @@ def _train_and_predict(clf, X, y, train, test):
     """ Fit a classifier clf and train set
     and return predictions on test set"""
 
+    from sklearn.metrics import accuracy_score
     clf.fit(X[train], y[train])
     y_pred = clf.predict(X[test])
     return accuracy_score(y[test], y_pred)
@@ -528,6 +1696,7 @@ def _get_subjects_splits(imgs, subjects, dx_group, groups, n_iter=100,
                          test_size=.25, random_state=42):
     """Returns X, y
     """
+    from sklearn.model_selection import StratifiedShuffleSplit
     X, y, idx = _get_classification_data(imgs, dx_group, groups,
                                          return_idx=True)
     sss = StratifiedShuffleSplit(n_splits=100, test_size=test_size,